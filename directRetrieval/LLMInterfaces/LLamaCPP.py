@@ -6,6 +6,8 @@ from functools import wraps
 from typing import Union, List, Dict, TypedDict, Generator
 import typing
 import json
+import time
+from .. import instrumentation
 
 class LLamaCPP(SyncLLMInterface):
     llama: llama_cpp.Llama
@@ -33,38 +35,44 @@ class LLamaCPP(SyncLLMInterface):
     def getResponse(self, messages: List[llama_cpp.llama_types.ChatCompletionRequestMessage], properties: Union[Dict,None], temperature: int = 0, stream: bool = False) -> Union[Dict,str,Generator,None]:
         assert not stream or properties is None, "Stream is only supported for responses without properties"
         if properties is not None:
-            response = self.llama.create_chat_completion(
-                messages=messages,
-                response_format={
-                    "type": "json_object",
-                    "schema": {
-                        "type": "object",
-                        "properties": properties,
-                        "required": list(properties.keys()),
-                    }
-                },
-                temperature=temperature
-            )
+            with instrumentation.stage("generate", interface="LLamaCPP"):
+                response = self.llama.create_chat_completion(
+                    messages=messages,
+                    response_format={
+                        "type": "json_object",
+                        "schema": {
+                            "type": "object",
+                            "properties": properties,
+                            "required": list(properties.keys()),
+                        }
+                    },
+                    temperature=temperature
+                )
             # assert response is a TypedDict
             assert isinstance(response, dict)
+            instrumentation.usage(response, interface="LLamaCPP")
             response = response["choices"][0]['message']['content']
             assert isinstance(response, str)
 
             try:
-                jsonOutput = json.loads(response)
+                with instrumentation.stage("json_parse"):
+                    jsonOutput = json.loads(response)
             except Exception as e:
                 print(response)
                 raise e
             return jsonOutput
         else:
-            response = self.llama.create_chat_completion(
-                messages=messages,
-                temperature=0,
-                stream=stream
-            )
+            start = time.perf_counter()
+            with instrumentation.stage("generate", interface="LLamaCPP", stream=stream):
+                response = self.llama.create_chat_completion(
+                    messages=messages,
+                    temperature=0,
+                    stream=stream
+                )
             if stream:
                 def stream_response() -> Generator[str, None, None]:
                     print("Streaming response:")
+                    firstToken = None
                     try:
                         for item in response:
                             assert isinstance(item, dict)
@@ -72,12 +80,18 @@ class LLamaCPP(SyncLLMInterface):
                             if 'content' in delta:
                                 assert isinstance(delta, dict)
                                 assert isinstance(delta['content'], str)
+                                if firstToken is None:
+                                    firstToken = time.perf_counter()
+                                    instrumentation.timing("time_to_first_token", firstToken - start, interface="LLamaCPP")
                                 yield delta['content']
                             else:
                                 break
                     except Exception as e:
                         raise e
+                    if firstToken is not None:
+                        instrumentation.timing("decode", time.perf_counter() - firstToken, interface="LLamaCPP")
                 return stream_response()
             else:
                 assert isinstance(response, dict)
+                instrumentation.usage(response, interface="LLamaCPP")
                 return response["choices"][0]["message"]["content"]
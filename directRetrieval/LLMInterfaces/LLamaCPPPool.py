@@ -0,0 +1,358 @@
+from typing import List, Dict, Set, Union, Generator, AsyncIterator, Callable, Tuple
+import os
+import time
+import queue
+import asyncio
+import itertools
+import threading
+import collections
+import multiprocessing
+import multiprocessing.connection
+from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface
+from .. import instrumentation
+
+# Several llama_cpp models in worker processes, for CPU machines where one model generating one response at a
+# time leaves most cores idle. Every worker loads the model with mmap, so the weights are read once into the
+# page cache and shared, and runs with its own share of the cores. The pool hands every call to an idle worker
+# over that worker's own pipes, calls wait in the pool while every worker is busy. Nothing is shared between the
+# workers, so a worker killed at any point cannot leave a lock held that the others wait on. Workers are spawned
+# rather than forked, llama.cpp threads do not survive a fork.
+
+class _ForwardHook(instrumentation.Hook):
+    def __init__(self, send: Callable):
+        self.send = send
+
+    def onStageEnd(self, stage: str, seconds: float, attributes: Dict):
+        self.send(("timing", (stage, seconds, attributes)))
+
+    def onTiming(self, stage: str, seconds: float, attributes: Dict):
+        self.send(("timing", (stage, seconds, attributes)))
+
+    def onTokens(self, promptTokens: int, completionTokens: int, attributes: Dict):
+        self.send(("tokens", (promptTokens, completionTokens, attributes)))
+
+# runs in the worker processes. Messages to the pool are (taskID, kind, payload); kind is one of
+# ready, failed, timing, tokens, chunk, result, error
+def _work(modelPath: str, kwargs: Dict, tasks: multiprocessing.connection.Connection, results: multiprocessing.connection.Connection):
+    try:
+        from .LLamaCPP import LLamaCPP
+        llm = LLamaCPP(modelPath, **kwargs)
+    except Exception as exception:
+        results.send((None, "failed", f"{type(exception).__name__}: {exception}"))
+        return
+    results.send((None, "ready", os.getpid()))
+    taskID = None
+    # timings and token counts measured in the worker are sent to the pool, whose hooks record them
+    instrumentation.addHook(_ForwardHook(lambda message: results.send((taskID, *message))))
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        taskID, messages, properties, temperature, stream = task
+        try:
+            response = llm.getResponse(messages, properties, temperature, stream)
+            if stream:
+                assert not isinstance(response, (dict, str))
+                for chunk in response:
+                    results.send((taskID, "chunk", chunk))
+                response = None
+            results.send((taskID, "result", response))
+        except Exception as exception:
+            # exceptions are sent as text, not every exception can be pickled
+            results.send((taskID, "error", f"{type(exception).__name__}: {exception}"))
+
+class _Worker:
+    def __init__(self, process: multiprocessing.process.BaseProcess, tasks: multiprocessing.connection.Connection, results: multiprocessing.connection.Connection, failures: int = 0):
+        self.process = process
+        self.tasks = tasks
+        self.results = results
+        # ID of the call the worker is answering, None when idle
+        self.taskID: Union[int, None] = None
+        self.ready = False
+        # starts in a row that exited before the model was loaded, and the error of the last one
+        self.failures = failures
+        self.error: Union[str, None] = None
+
+class LLamaCPPPool(SyncLLMInterface):
+    workers: int
+    threadsPerWorker: int
+    pids: List[int]
+    restarts: int
+    # a worker that exits before loading the model is started again after restartDelay, doubled for every
+    # failure in a row, and left stopped after maxRestarts of them
+    restartDelay: float
+    maxRestarts: int
+
+    # workers defaults to one per 4 cores, threadsPerWorker to the cores divided between the workers.
+    # Other keyword arguments are given to llama_cpp.Llama in every worker.
+    def __init__(self, model_path: str, workers: Union[int, None] = None, threadsPerWorker: Union[int, None] = None, restartDelay: float = 1.0, maxRestarts: int = 5, **kwargs):
+        cores = os.cpu_count() or 1
+        self.workers = workers if workers is not None else max(1, cores // 4)
+        assert self.workers > 0, "A pool needs at least one worker"
+        # n_threads is the llama_cpp name of threadsPerWorker
+        if "n_threads" in kwargs:
+            if threadsPerWorker is not None and threadsPerWorker != kwargs["n_threads"]:
+                raise ValueError(f"n_threads={kwargs['n_threads']} conflicts with threadsPerWorker={threadsPerWorker}")
+            threadsPerWorker = kwargs.pop("n_threads")
+        self.threadsPerWorker = threadsPerWorker if threadsPerWorker is not None else max(1, cores // self.workers)
+        kwargs = {"use_mmap": True, "verbose": False, **kwargs, "n_threads": self.threadsPerWorker}
+        kwargs.setdefault("n_threads_batch", self.threadsPerWorker)
+
+        self._modelPath = model_path
+        self._kwargs = kwargs
+        self._context = multiprocessing.get_context("spawn")
+        self._closed = False
+        self.pids = [0] * self.workers
+        self.restarts = 0
+        self.restartDelay = restartDelay
+        self.maxRestarts = maxRestarts
+        # worker index -> time it is started again, for workers waiting after a failed start
+        self._restartAt: Dict[int, float] = {}
+        self._stopped: Set[int] = set()
+        self._taskIDs = itertools.count()
+        # task ID -> (sink, time submitted), for every call not answered yet
+        self._sinks: Dict[int, Tuple[Callable, float]] = {}
+        # calls waiting for an idle worker
+        self._pending: "collections.deque[Tuple]" = collections.deque()
+        self._lock = threading.Lock()
+        self._workers = [self._startWorker() for _ in range(self.workers)]
+
+        # wait until every worker loaded its model, so a bad path or option fails here
+        for i, worker in enumerate(self._workers):
+            while not worker.results.poll(1.0):
+                if not worker.process.is_alive():
+                    self.close()
+                    raise RuntimeError(f"Worker {i} exited while loading {model_path}")
+            _, kind, payload = worker.results.recv()
+            if kind == "failed":
+                self.close()
+                raise RuntimeError(f"Worker {i} could not load {model_path}: {payload}")
+            self.pids[i] = payload
+            worker.ready = True
+
+        self._wakeReader, self._wakeWriter = self._context.Pipe(duplex=False)
+        self._reader = threading.Thread(target=self._readResults, daemon=True)
+        self._reader.start()
+
+    def _startWorker(self, failures: int = 0) -> _Worker:
+        tasksReader, tasksWriter = self._context.Pipe(duplex=False)
+        resultsReader, resultsWriter = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_work, args=(self._modelPath, self._kwargs, tasksReader, resultsWriter), daemon=True)
+        process.start()
+        # the worker's ends are closed here, so a dead worker shows as EOF on its results pipe
+        tasksReader.close()
+        resultsWriter.close()
+        return _Worker(process, tasksWriter, resultsReader, failures)
+
+    # hand waiting calls to idle workers, called with the lock held
+    def _dispatch(self):
+        for i, worker in enumerate(self._workers):
+            if not self._pending:
+                return
+            if not worker.ready or worker.taskID is not None:
+                continue
+            task = self._pending.popleft()
+            try:
+                worker.tasks.send(task)
+            except OSError:
+                # the worker died, the call goes to another one and the reader restarts it
+                self._pending.appendleft(task)
+                worker.ready = False
+                continue
+            worker.taskID = task[0]
+            sink, submitted = self._sinks[task[0]]
+            instrumentation.timing("queue_wait", time.perf_counter() - submitted, interface="LLamaCPPPool", worker=i)
+
+    # a worker killed by a crash or the OOM killer fails the call it was answering and is started again,
+    # called with the lock held
+    def _restart(self, i: int):
+        worker = self._workers[i]
+        worker.process.join()
+        worker.tasks.close()
+        worker.results.close()
+        entry = self._sinks.pop(worker.taskID, None) if worker.taskID is not None else None
+        if entry is not None:
+            entry[0]("error", f"Worker {i} exited with code {worker.process.exitcode}")
+        failures = 0 if worker.ready else worker.failures + 1
+        worker.ready = False
+        worker.failures = failures
+        if failures == 0:
+            self._startAgain(i)
+        elif failures > self.maxRestarts:
+            self._stopped.add(i)
+            instrumentation.event("worker_stopped", interface="LLamaCPPPool", worker=i)
+        else:
+            self._restartAt[i] = time.perf_counter() + self.restartDelay * 2 ** (failures - 1)
+        if failures and not any(worker.ready for worker in self._workers):
+            # nothing could answer the waiting calls before the next start, if that one loads at all
+            self._failPending(f"No worker of the pool is running, the last one exited with: {worker.error or f'code {worker.process.exitcode}'}")
+
+    def _startAgain(self, i: int):
+        self._restartAt.pop(i, None)
+        instrumentation.event("worker_restart", interface="LLamaCPPPool", worker=i)
+        self.restarts += 1
+        self._workers[i] = self._startWorker(self._workers[i].failures)
+
+    # fails the calls waiting for a worker, called with the lock held
+    def _failPending(self, error: str):
+        while self._pending:
+            entry = self._sinks.pop(self._pending.popleft()[0], None)
+            if entry is not None:
+                entry[0]("error", error)
+
+    # delivers the messages of the workers to the callers waiting for them
+    def _readResults(self):
+        while not self._closed:
+            with self._lock:
+                now = time.perf_counter()
+                for i in [i for i, at in self._restartAt.items() if at <= now]:
+                    self._startAgain(i)
+                timeout = min(self._restartAt.values()) - now if self._restartAt else None
+                connections = {worker.results: i for i, worker in enumerate(self._workers) if i not in self._restartAt and i not in self._stopped}
+            for connection in multiprocessing.connection.wait([*connections, self._wakeReader], timeout):
+                if connection is self._wakeReader or self._closed:
+                    continue
+                i = connections[connection]
+                try:
+                    taskID, kind, payload = connection.recv()
+                except (EOFError, OSError):
+                    with self._lock:
+                        if not self._closed:
+                            self._restart(i)
+                            self._dispatch()
+                    continue
+                if kind == "timing":
+                    stage, seconds, attributes = payload
+                    instrumentation.timing(stage, seconds, **attributes)
+                    continue
+                if kind == "tokens":
+                    promptTokens, completionTokens, attributes = payload
+                    instrumentation.tokens(promptTokens, completionTokens, **attributes)
+                    continue
+                with self._lock:
+                    worker = self._workers[i]
+                    if kind in ("ready", "failed"):
+                        # a restarted worker, one that fails to load is found dead and started again later
+                        if kind == "ready":
+                            self.pids[i] = payload
+                            worker.ready = True
+                            worker.failures = 0
+                            self._dispatch()
+                        else:
+                            worker.error = payload
+                        continue
+                    entry = self._sinks.get(taskID)
+                    if kind in ("result", "error"):
+                        self._sinks.pop(taskID, None)
+                        worker.taskID = None
+                        self._dispatch()
+                if entry is not None:
+                    entry[0](kind, payload)
+
+    # queue a call, sink(kind, payload) is called from the reader thread with its messages
+    def _submit(self, messages: List[Dict[str, str]], properties: Union[Dict, None], temperature: int, stream: bool, sink: Callable):
+        assert not stream or properties is None, "Stream is only supported for responses without properties"
+        with self._lock:
+            assert not self._closed, "The pool is closed"
+            if len(self._stopped) == len(self._workers):
+                raise RuntimeError(f"Every worker of the pool stopped after failing to load {self._modelPath}")
+            taskID = next(self._taskIDs)
+            self._sinks[taskID] = (sink, time.perf_counter())
+            self._pending.append((taskID, messages, properties, temperature, stream))
+            self._dispatch()
+
+    def getResponse(self, messages: List[Dict[str, str]], properties: Union[Dict, None], temperature: int = 0, stream: bool = False) -> Union[Union[Dict, str], Generator[str, None, None]]:
+        received: "queue.Queue[Tuple[str, object]]" = queue.Queue()
+        self._submit(messages, properties, temperature, stream, lambda kind, payload: received.put((kind, payload)))
+
+        def nextMessage() -> Tuple[str, object]:
+            kind, payload = received.get()
+            if kind == "error":
+                raise RuntimeError(payload)
+            return kind, payload
+
+        if stream:
+            def stream_response() -> Generator[str, None, None]:
+                while True:
+                    kind, payload = nextMessage()
+                    if kind == "result":
+                        break
+                    assert isinstance(payload, str)
+                    yield payload
+            return stream_response()
+        _, response = nextMessage()
+        assert isinstance(response, (dict, str))
+        return response
+
+    def asAsync(self) -> "AsyncLLamaCPPPool":
+        return AsyncLLamaCPPPool(self)
+
+    # stops the workers, calls not answered yet fail
+    def close(self):
+        if getattr(self, "_closed", False):
+            return
+        with self._lock:
+            self._closed = True
+            sinks = [sink for sink, _ in self._sinks.values()]
+            self._sinks.clear()
+            self._pending.clear()
+        if hasattr(self, "_reader"):
+            self._wakeWriter.send(None)
+            self._reader.join()
+        for worker in self._workers:
+            try:
+                worker.tasks.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.tasks.close()
+            worker.results.close()
+        for sink in sinks:
+            sink("error", "The pool is closed")
+
+    def __enter__(self) -> "LLamaCPPPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# the same workers behind the async interface, made with LLamaCPPPool(...).asAsync() or from the pool arguments
+class AsyncLLamaCPPPool(AsyncLLMInterface):
+    pool: LLamaCPPPool
+
+    def __init__(self, pool_or_model_path: Union[LLamaCPPPool, str], *args, **kwargs):
+        self.pool = pool_or_model_path if isinstance(pool_or_model_path, LLamaCPPPool) else LLamaCPPPool(pool_or_model_path, *args, **kwargs)
+
+    async def getResponse(self, messages: List[Dict[str, str]], properties: Union[Dict, None], temperature: int = 0, stream: bool = False) -> Union[Union[Dict, str], AsyncIterator[str]]:
+        loop = asyncio.get_running_loop()
+        received: "asyncio.Queue[Tuple[str, object]]" = asyncio.Queue()
+        self.pool._submit(messages, properties, temperature, stream, lambda kind, payload: loop.call_soon_threadsafe(received.put_nowait, (kind, payload)))
+
+        async def nextMessage() -> Tuple[str, object]:
+            kind, payload = await received.get()
+            if kind == "error":
+                raise RuntimeError(payload)
+            return kind, payload
+
+        if stream:
+            async def stream_response() -> AsyncIterator[str]:
+                while True:
+                    kind, payload = await nextMessage()
+                    if kind == "result":
+                        break
+                    assert isinstance(payload, str)
+                    yield payload
+            return stream_response()
+        _, response = await nextMessage()
+        assert isinstance(response, (dict, str))
+        return response
+
+    def close(self):
+        self.pool.close()
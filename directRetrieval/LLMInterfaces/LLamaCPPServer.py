@@ -4,12 +4,34 @@ import json
 import httpx
 import sys
 import os
+import time
 
-from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface
+from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface, AsyncClientPool
+from .. import instrumentation
+
+def _serialize(data: Dict, options: Union[Dict, None] = None) -> bytes:
+    if options:
+        data = {**data, **options}
+    with instrumentation.stage("serialize") as serializeStage:
+        body = json.dumps(data).encode("utf-8")
+        serializeStage.set("bytes", len(body))
+    return body
 
 class LlamaCPPServer(SyncLLMInterface):
-    def __init__(self, url: str):
+    # extra request fields sent with every call, e.g. {"id_slot": 0, "cache_prompt": True}
+    options: Dict
+
+    def __init__(self, url: str, options: Union[Dict, None] = None):
         self.url = url
+        self.options = options if options is not None else {}
+        # keep-alive connections, shared by the copies made with withOptions
+        self.session = requests.Session()
+
+    def withOptions(self, options: Dict) -> "LlamaCPPServer":
+        llm = LlamaCPPServer.__new__(LlamaCPPServer)
+        llm.__dict__.update(self.__dict__)
+        llm.options = {**self.options, **options}
+        return llm
 
     def getResponse(
                     self,messages: List[Dict[str,str]],
@@ -42,16 +64,22 @@ class LlamaCPPServer(SyncLLMInterface):
                 'temperature': temperature,
             }
 
-            response = requests.post(
-                                    self.url,
-                                    headers=headers,
-                                    json=data,
-                                    timeout=1000000,
-                                    stream=stream
-                                    )
-            response = response.json()['choices'][0]['message']['content']
+            body = _serialize(data, self.options)
+            with instrumentation.stage("network", interface="LlamaCPPServer"):
+                response = self.session.post(
+                                        self.url,
+                                        headers=headers,
+                                        data=body,
+                                        timeout=1000000,
+                                        stream=stream
+                                        )
+            with instrumentation.stage("response_parse"):
+                responseJSON = response.json()
+            instrumentation.usage(responseJSON, interface="LlamaCPPServer")
+            response = responseJSON['choices'][0]['message']['content']
             try:
-                jsonOutput = json.loads(response)
+                with instrumentation.stage("json_parse"):
+                    jsonOutput = json.loads(response)
             except Exception as e:
                 print(response)
                 raise e
@@ -62,17 +90,21 @@ class LlamaCPPServer(SyncLLMInterface):
                 'temperature': temperature,
                 'stream': stream,
             }
-            response = requests.post(
-                                    self.url,
-                                    headers=headers,
-                                    json=data,
-                                    timeout=1000000,
-                                    stream=stream
-                                    )
+            body = _serialize(data, self.options)
+            start = time.perf_counter()
+            with instrumentation.stage("network", interface="LlamaCPPServer", stream=stream):
+                response = self.session.post(
+                                        self.url,
+                                        headers=headers,
+                                        data=body,
+                                        timeout=1000000,
+                                        stream=stream
+                                        )
 
             if stream:
                 def stream_response() -> Generator[str, None, None]:
                     print("Streaming response:")
+                    firstToken = None
                     try:
                         for line in response.iter_lines():
                             if line:
@@ -83,19 +115,72 @@ class LlamaCPPServer(SyncLLMInterface):
                                     message = json.loads(message)
                                     delta = message["choices"][0]["delta"]
                                     if "content" in delta:
+                                        if firstToken is None:
+                                            firstToken = time.perf_counter()
+                                            instrumentation.timing("time_to_first_token", firstToken - start, interface="LlamaCPPServer")
                                         yield delta["content"]
                                     else:
                                         break
                     except Exception as e:
                         raise e
+                    if firstToken is not None:
+                        instrumentation.timing("decode", time.perf_counter() - firstToken, interface="LlamaCPPServer")
                 return stream_response()
             else:
-                response = response.json()['choices'][0]['message']['content']
+                with instrumentation.stage("response_parse"):
+                    responseJSON = response.json()
+                instrumentation.usage(responseJSON, interface="LlamaCPPServer")
+                response = responseJSON['choices'][0]['message']['content']
                 return response
 
 class AsyncLlamaCPPServer(AsyncLLMInterface):
-    def __init__(self, url: str):
+    options: Dict
+
+    def __init__(self, url: str, options: Union[Dict, None] = None):
         self.url = url
+        self.options = options if options is not None else {}
+        self._clients = AsyncClientPool()
+
+    def withOptions(self, options: Dict) -> "AsyncLlamaCPPServer":
+        llm = AsyncLlamaCPPServer.__new__(AsyncLlamaCPPServer)
+        llm.__dict__.update(self.__dict__)
+        llm.options = {**self.options, **options}
+        return llm
+
+    # close the connections of the running loop, shared with the copies made with withOptions
+    async def aclose(self):
+        await self._clients.aclose()
+
+    async def _streamResponse(self, headers: Dict, data: Dict) -> AsyncGenerator[str, None]:
+        body = _serialize(data, self.options)
+        start = time.perf_counter()
+        firstToken = None
+        async with self._clients.client() as client:
+            async with client.stream(
+                                    "POST",
+                                    self.url,
+                                    headers=headers,
+                                    content=body,
+                                    timeout=1000000
+                                    ) as response:
+                async for line in response.aiter_lines():
+                    if line:
+                        decoded_line = line
+                        if decoded_line.startswith("data: "):
+                            message = decoded_line[len("data: "):]
+                            message = message.strip()
+                            message = json.loads(message)
+                            delta = message["choices"][0]["delta"]
+                            if "content" in delta:
+                                if firstToken is None:
+                                    firstToken = time.perf_counter()
+                                    instrumentation.timing("time_to_first_token", firstToken - start, interface="AsyncLlamaCPPServer")
+                                yield delta["content"]
+                            else:
+                                break
+        if firstToken is not None:
+            instrumentation.timing("decode", time.perf_counter() - firstToken, interface="AsyncLlamaCPPServer")
+
     async def getResponse(
             self,
             messages: List[Dict[str,str]],
@@ -127,16 +212,25 @@ class AsyncLlamaCPPServer(AsyncLLMInterface):
                 "stream": stream
             }
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                                            self.url,
-                                            headers=headers,
-                                            json=data,
-                                            timeout=1000000
-                                            )
-                response = response.json()['choices'][0]['message']['content']
+            if stream:
+                # the raw JSON text as it is generated
+                return self._streamResponse(headers, data)
+            body = _serialize(data, self.options)
+            async with self._clients.client() as client:
+                with instrumentation.stage("network", interface="AsyncLlamaCPPServer"):
+                    response = await client.post(
+                                                self.url,
+                                                headers=headers,
+                                                content=body,
+                                                timeout=1000000
+                                                )
+                with instrumentation.stage("response_parse"):
+                    responseJSON = response.json()
+                instrumentation.usage(responseJSON, interface="AsyncLlamaCPPServer")
+                response = responseJSON['choices'][0]['message']['content']
                 try:
-                    jsonOutput = json.loads(response)
+                    with instrumentation.stage("json_parse"):
+                        jsonOutput = json.loads(response)
                 except Exception as e:
                     print(response)
                     raise e
@@ -148,37 +242,19 @@ class AsyncLlamaCPPServer(AsyncLLMInterface):
                 'stream': stream
             }
             if stream:
-                async def stream_response() -> AsyncGenerator[str, None]:
-                    async with httpx.AsyncClient() as client:
-                        async with client.stream(
-                                                "POST",
-                                                self.url,
-                                                headers=headers,
-                                                json=data,
-                                                timeout=1000000
-                                                ) as response:
-                            async for line in response.aiter_lines():
-                                print(line)
-                                if line:
-                                    decoded_line = line
-                                    if decoded_line.startswith("data: "):
-                                        message = decoded_line[len("data: "):]
-                                        message = message.strip()
-                                        message = json.loads(message)
-                                        delta = message["choices"][0]["delta"]
-                                        if "content" in delta:
-                                            yield delta["content"]
-                                        else:
-                                            print("[async server]Stream ended")
-                                            break
-                return stream_response()
+                return self._streamResponse(headers, data)
             else:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                                                self.url,
-                                                headers=headers,
-                                                json=data,
-                                                timeout=1000000)
-                    response = response.json()['choices'][0]['message']
+                body = _serialize(data, self.options)
+                async with self._clients.client() as client:
+                    with instrumentation.stage("network", interface="AsyncLlamaCPPServer"):
+                        response = await client.post(
+                                                    self.url,
+                                                    headers=headers,
+                                                    content=body,
+                                                    timeout=1000000)
+                    with instrumentation.stage("response_parse"):
+                        responseJSON = response.json()
+                    instrumentation.usage(responseJSON, interface="AsyncLlamaCPPServer")
+                    response = responseJSON['choices'][0]['message']
                     response = response['content']
                     return response
@@ -1,6 +1,21 @@
 # TODO figure out ollama structured outputs
-from ollama import Client
+from typing import Union
 
+# created on first use: building a client at import time connected every importer to Ollama
+_client = None
 
-ollama = Client()
+def ollamaClient(host: Union[str, None] = None):
+    global _client
+    if host is not None:
+        from ollama import Client
+        return Client(host=host)
+    if _client is None:
+        from ollama import Client
+        _client = Client()
+    return _client
 
+# the shared client is still importable as `ollama`, it is only created when that name is first looked up
+def __getattr__(name: str):
+    if name == "ollama":
+        return ollamaClient()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
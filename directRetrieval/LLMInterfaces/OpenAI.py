@@ -2,13 +2,66 @@ from typing import Dict, List, Union, Generator, AsyncGenerator
 import requests
 import json
 import httpx
-from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface
+import time
+import asyncio
+from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface, AsyncClientPool
+from .RateLimiter import RateLimiter, isRetryable
+from .. import instrumentation
 
 class OpenAI(AsyncLLMInterface):
     url: str = "https://api.openai.com/v1/chat/completions"
     api_key: str
-    def __init__(self, api_key: str):
+    rateLimiter: RateLimiter
+    def __init__(self, api_key: str, rateLimiter: Union[RateLimiter, None] = None):
         self.api_key = api_key
+        self.rateLimiter = rateLimiter if rateLimiter is not None else RateLimiter()
+        self._clients = AsyncClientPool()
+
+    async def aclose(self):
+        await self._clients.aclose()
+
+    async def _post(self, headers: Dict, data: Dict) -> Dict:
+        limiter = self.rateLimiter
+        tokens = limiter.estimateTokens(data["messages"], data.get("response_format"))
+        with instrumentation.stage("serialize") as serializeStage:
+            body = json.dumps(data).encode("utf-8")
+            serializeStage.set("bytes", len(body))
+        attempt = 0
+        while True:
+            try:
+                async with limiter.asyncLimit(tokens):
+                    with instrumentation.stage("network", interface="OpenAI", attempt=attempt):
+                        async with self._clients.client() as client:
+                            response = await client.post(
+                                                    self.url,
+                                                    headers=headers,
+                                                    content=body,
+                                                    timeout=1000000
+                                                    )
+            except httpx.TransportError:
+                if attempt >= limiter.maxRetries:
+                    raise
+                instrumentation.event("retry", status=0, attempt=attempt)
+                limiter.refund(tokens)
+                await asyncio.sleep(limiter.backoffDelay(attempt))
+                attempt += 1
+                continue
+            limiter.updateFromHeaders(response.headers)
+            if isRetryable(response.status_code) and attempt < limiter.maxRetries:
+                delay = limiter.backoffDelay(attempt, limiter.retryAfter(response.headers))
+                instrumentation.event("retry", status=response.status_code, attempt=attempt)
+                if response.status_code == 429:
+                    limiter.pause(delay)
+                limiter.refund(tokens)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            response.raise_for_status()
+            with instrumentation.stage("response_parse"):
+                responseJSON = response.json()
+            instrumentation.usage(responseJSON, interface=type(self).__name__)
+            limiter.settle(tokens, responseJSON.get("usage"))
+            return responseJSON
 
     async def getResponse(
                     self,messages: List[Dict[str,str]],
@@ -40,41 +93,73 @@ class OpenAI(AsyncLLMInterface):
                 'temperature': temperature,
             }
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                                        self.url,
-                                        headers=headers,
-                                        json=data,
-                                        timeout=1000000
-                                        )
-                response = response.json()['choices'][0]['message']['content']
-                try:
+            response = (await self._post(headers, data))['choices'][0]['message']['content']
+            try:
+                with instrumentation.stage("json_parse"):
                     jsonOutput = json.loads(response)
-                except Exception as e:
-                    print(response)
-                    raise e
-                return jsonOutput
+            except Exception as e:
+                print(response)
+                raise e
+            return jsonOutput
         else:
             data = {
                 "model": "gpt-4o-mini",
                 'messages': messages,
                 'temperature': temperature,
             }
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                                        self.url,
-                                        headers=headers,
-                                        json=data,
-                                        timeout=1000000,
-                                        )
-                response = response.json()['choices'][0]['message']['content']
-                return response
+            response = (await self._post(headers, data))['choices'][0]['message']['content']
+            return response
             
 class OpenAISync(SyncLLMInterface):
     url: str = "https://api.openai.com/v1/chat/completions"
     api_key: str
-    def __init__(self, api_key: str):
+    rateLimiter: RateLimiter
+    def __init__(self, api_key: str, rateLimiter: Union[RateLimiter, None] = None):
         self.api_key = api_key
+        self.rateLimiter = rateLimiter if rateLimiter is not None else RateLimiter()
+        self.session = requests.Session()
+
+    def _post(self, headers: Dict, data: Dict) -> Dict:
+        limiter = self.rateLimiter
+        tokens = limiter.estimateTokens(data["messages"], data.get("response_format"))
+        with instrumentation.stage("serialize") as serializeStage:
+            body = json.dumps(data).encode("utf-8")
+            serializeStage.set("bytes", len(body))
+        attempt = 0
+        while True:
+            try:
+                with limiter.limit(tokens):
+                    with instrumentation.stage("network", interface="OpenAISync", attempt=attempt):
+                        response = self.session.post(
+                                                self.url,
+                                                headers=headers,
+                                                data=body,
+                                                timeout=1000000
+                                                )
+            except requests.ConnectionError:
+                if attempt >= limiter.maxRetries:
+                    raise
+                instrumentation.event("retry", status=0, attempt=attempt)
+                limiter.refund(tokens)
+                time.sleep(limiter.backoffDelay(attempt))
+                attempt += 1
+                continue
+            limiter.updateFromHeaders(response.headers)
+            if isRetryable(response.status_code) and attempt < limiter.maxRetries:
+                delay = limiter.backoffDelay(attempt, limiter.retryAfter(response.headers))
+                instrumentation.event("retry", status=response.status_code, attempt=attempt)
+                if response.status_code == 429:
+                    limiter.pause(delay)
+                limiter.refund(tokens)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            response.raise_for_status()
+            with instrumentation.stage("response_parse"):
+                responseJSON = response.json()
+            instrumentation.usage(responseJSON, interface=type(self).__name__)
+            limiter.settle(tokens, responseJSON.get("usage"))
+            return responseJSON
 
     def getResponse(
                     self,messages: List[Dict[str,str]],
@@ -106,15 +191,10 @@ class OpenAISync(SyncLLMInterface):
                 'temperature': temperature,
             }
 
-            response = requests.post(
-                                    self.url,
-                                    headers=headers,
-                                    json=data,
-                                    timeout=1000000
-                                    )
-            response = response.json()['choices'][0]['message']['content']
+            response = self._post(headers, data)['choices'][0]['message']['content']
             try:
-                jsonOutput = json.loads(response)
+                with instrumentation.stage("json_parse"):
+                    jsonOutput = json.loads(response)
             except Exception as e:
                 print(response)
                 raise e
@@ -125,11 +205,5 @@ class OpenAISync(SyncLLMInterface):
                 'messages': messages,
                 'temperature': temperature,
             }
-            response = requests.post(
-                                    self.url,
-                                    headers=headers,
-                                    json=data,
-                                    timeout=1000000,
-                                    )
-            response = response.json()['choices'][0]['message']['content']
+            response = self._post(headers, data)['choices'][0]['message']['content']
             return response
\ No newline at end of file
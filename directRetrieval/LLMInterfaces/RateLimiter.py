@@ -0,0 +1,178 @@
+from typing import Dict, List, Union, Iterator, AsyncIterator
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+
+# OpenAI reset headers look like "1s", "6m0s", "120ms" or "0.5s"
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parseDuration(value: str) -> Union[float, None]:
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+class _Bucket:
+    capacity: float
+    level: float
+    rate: float
+    updated: float
+
+    def __init__(self, perMinute: float):
+        self.capacity = perMinute
+        self.level = perMinute
+        self.rate = perMinute / 60
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # take the amount right away (the level may go negative) and return how long to wait until it is paid back
+    def take(self, amount: float, now: float) -> float:
+        self.refill(now)
+        self.level -= min(amount, self.capacity)
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+    def resize(self, perMinute: float):
+        self.level = self.level * perMinute / self.capacity
+        self.capacity = perMinute
+        self.rate = perMinute / 60
+
+# requests and tokens per minute are token buckets, concurrent requests are bounded by a semaphore,
+# the buckets adapt to the x-ratelimit-* response headers and 429/5xx are retried with jittered backoff
+class RateLimiter:
+    maxConcurrency: int
+    maxRetries: int
+    baseDelay: float
+    maxDelay: float
+    completionTokens: int
+
+    def __init__(
+            self,
+            requestsPerMinute: float = 500,
+            tokensPerMinute: float = 200000,
+            maxConcurrency: int = 16,
+            maxRetries: int = 6,
+            baseDelay: float = 0.5,
+            maxDelay: float = 60.0,
+            completionTokens: int = 256):
+        self.maxConcurrency = maxConcurrency
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.completionTokens = completionTokens
+        self._requests = _Bucket(requestsPerMinute)
+        self._tokens = _Bucket(tokensPerMinute)
+        self._pausedUntil = 0.0
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(maxConcurrency)
+        # asyncio semaphores are bound to the event loop that uses them
+        self._asyncSemaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+    def estimateTokens(self, messages: List[Dict[str, str]], properties: Union[Dict, None] = None) -> int:
+        # roughly 4 characters per token plus the per-message overhead of the chat format
+        characters = sum(len(message["content"]) for message in messages)
+        if properties is not None:
+            characters += len(json.dumps(properties))
+        return characters // 4 + 4 * len(messages) + self.completionTokens
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._requests.take(1, now), self._tokens.take(tokens, now))
+            return max(wait, self._pausedUntil - now)
+
+    @contextmanager
+    def limit(self, tokens: int) -> Iterator[None]:
+        with self._semaphore:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+            yield
+
+    @asynccontextmanager
+    async def asyncLimit(self, tokens: int) -> AsyncIterator[None]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._asyncSemaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.maxConcurrency)
+                self._asyncSemaphores[loop] = semaphore
+        async with semaphore:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield
+
+    # give back the difference between the estimated and the actual token usage
+    def settle(self, estimatedTokens: int, usage: Union[Dict, None]):
+        if not usage or "total_tokens" not in usage:
+            return
+        with self._lock:
+            self._tokens.level = min(self._tokens.capacity, self._tokens.level + estimatedTokens - usage["total_tokens"])
+
+    # give back the tokens reserved for an attempt that was retried, the next attempt reserves them again
+    def refund(self, tokens: int):
+        with self._lock:
+            self._tokens.level = min(self._tokens.capacity, self._tokens.level + min(tokens, self._tokens.capacity))
+
+    def updateFromHeaders(self, headers):
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit is not None:
+                    try:
+                        if float(limit) != bucket.capacity:
+                            bucket.resize(float(limit))
+                    except ValueError:
+                        pass
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is not None:
+                    try:
+                        # the server's view wins when it is more pessimistic than ours
+                        bucket.refill(now)
+                        bucket.level = min(bucket.level, float(remaining))
+                    except ValueError:
+                        pass
+
+    def retryAfter(self, headers) -> Union[float, None]:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if value is not None:
+            seconds = parseDuration(value)
+            if seconds is not None:
+                return seconds
+        # without an explicit retry-after, wait for the bucket that resets last
+        resets = [parseDuration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name) is not None]
+        resets = [seconds for seconds in resets if seconds is not None]
+        return max(resets) if resets else None
+
+    def backoffDelay(self, attempt: int, retryAfter: Union[float, None] = None) -> float:
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        if retryAfter is not None:
+            delay = max(delay, min(self.maxDelay, retryAfter))
+        return delay
+
+    # make every caller wait, not only the one that was rate limited
+    def pause(self, seconds: float):
+        with self._lock:
+            self._pausedUntil = max(self._pausedUntil, time.monotonic() + seconds)
+
+def isRetryable(statusCode: int) -> bool:
+    return statusCode == 429 or statusCode >= 500
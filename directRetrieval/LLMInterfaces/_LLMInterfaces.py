@@ -1,9 +1,9 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Union, Generator, AsyncGenerator, AsyncIterator
-import requests
-import json
-import httpx
-import asyncio
+from typing import List, Dict, Tuple, Union, Generator, AsyncGenerator, AsyncIterator, TYPE_CHECKING
+from contextlib import asynccontextmanager
+if TYPE_CHECKING:
+    import asyncio
+    import httpx
 # from LLamaCPPServer import LlamaCPPServer, AsyncLlamaCPPServer
 
 # define LLMInferface as Union[SyncLLMInterface, AsyncLLMInterface]
@@ -17,4 +17,40 @@ class SyncLLMInterface(ABC):
 class AsyncLLMInterface(ABC):
     @abstractmethod
     async def getResponse(self, messages: List[Dict[str,str]], properties: Union[Dict,None], temperature: int = 0, stream: bool = False) -> Union[Union[Dict,str], AsyncIterator]:
-        ...
\ No newline at end of file
+        ...
+
+# one httpx client per event loop (clients cannot be shared between loops), kept open so connections are reused.
+# Every client is closed when its loop shuts down: asyncio.run cancels the tasks still pending when its coroutine
+# returns, including the one waiting to close the client, so the short lived loops of the sync wrappers do not leak
+# clients and sockets. Loops run by hand should call aclose before closing.
+class AsyncClientPool:
+    def __init__(self):
+        # loop -> (client, task closing the client when the loop shuts down)
+        self._clients: "Dict[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, asyncio.Task]]" = {}
+
+    @asynccontextmanager
+    async def client(self) -> "AsyncIterator[httpx.AsyncClient]":
+        import asyncio
+        loop = asyncio.get_running_loop()
+        entry = self._clients.get(loop)
+        if entry is None:
+            import httpx
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+            entry = self._clients[loop] = (client, loop.create_task(self._closeAtShutdown(loop, client)))
+        yield entry[0]
+
+    async def _closeAtShutdown(self, loop: "asyncio.AbstractEventLoop", client: "httpx.AsyncClient"):
+        try:
+            await loop.create_future()
+        finally:
+            self._clients.pop(loop, None)
+            await client.aclose()
+
+    # close the client of the running loop
+    async def aclose(self):
+        import asyncio
+        entry = self._clients.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            client, closer = entry
+            closer.cancel()
+            await client.aclose()
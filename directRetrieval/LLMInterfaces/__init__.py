@@ -1,9 +1,57 @@
 # from ._LLMInterfaces import SyncLLMInterface, AsyncLLMInterface
-from .OpenAI import OpenAI, OpenAISync
-from .LLamaCPPServer import LlamaCPPServer, AsyncLlamaCPPServer
-from ._LLMInterfaces import LLMInterface, SyncLLMInterface, AsyncLLMInterface
-# check if llama_cpp is installed
-try:
+import sys
+import types
+from typing import TYPE_CHECKING
+from ._LLMInterfaces import LLMInterface, SyncLLMInterface, AsyncLLMInterface, AsyncClientPool
+
+# backends are imported on first use, so a program only pays for the HTTP clients and native
+# libraries of the backend it uses: name -> module defining it
+_BACKENDS = {
+    "OpenAI": "OpenAI",
+    "OpenAISync": "OpenAI",
+    "RateLimiter": "RateLimiter",
+    "LlamaCPPServer": "LLamaCPPServer",
+    "AsyncLlamaCPPServer": "LLamaCPPServer",
+    "LLamaCPPPool": "LLamaCPPPool",
+    "AsyncLLamaCPPPool": "LLamaCPPPool",
+    "LLamaCPP": "LLamaCPP",
+}
+# backends needing a package that may not be installed, missing like before when it is not
+_OPTIONAL = {"LLamaCPP"}
+
+__all__ = ["LLMInterface", "SyncLLMInterface", "AsyncLLMInterface", "AsyncClientPool", *(name for name in _BACKENDS if name not in _OPTIONAL)]
+
+def __getattr__(name: str):
+    if name not in _BACKENDS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    try:
+        module = importlib.import_module(f".{_BACKENDS[name]}", __name__)
+    except ImportError as exception:
+        if name not in _OPTIONAL:
+            raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r} ({exception})") from exception
+    value = getattr(module, name)
+    # later lookups find the attribute without calling __getattr__
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_BACKENDS))
+
+# importing a submodule binds it on the package under its own name, which would hide the class of the
+# same name (OpenAI, RateLimiter, LLamaCPPPool, LLamaCPP), the class is bound instead
+class _Package(types.ModuleType):
+    def __setattr__(self, name: str, value):
+        if name in _BACKENDS and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+if TYPE_CHECKING:
+    from .OpenAI import OpenAI, OpenAISync
+    from .RateLimiter import RateLimiter
+    from .LLamaCPPServer import LlamaCPPServer, AsyncLlamaCPPServer
+    from .LLamaCPPPool import LLamaCPPPool, AsyncLLamaCPPPool
     from .LLamaCPP import LLamaCPP
-except ImportError:
-    pass
\ No newline at end of file
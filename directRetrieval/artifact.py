@@ -0,0 +1,178 @@
+from typing import List, Dict, Union, Tuple
+import os
+import json
+import mmap
+import struct
+import hashlib
+from .qna_store import QnAStore
+from .qna import QnAModel, loadConfigQnA, DEFAULT_SYSTEM_PROMPT_TEMPLATE
+from .LLMInterfaces import LLMInterface
+
+# Compiled persona artifact:
+#   magic "DRQA", format version, header length, JSON header, then 8 byte aligned sections.
+# The header holds the persona configuration, the content hashes and the (size, mtime) of its source files and
+# the (offset, length) of every section: the QnAStore columns, the rendered system message and the schema.
+ARTIFACT_MAGIC = b"DRQA"
+ARTIFACT_VERSION = 2
+_PREAMBLE = struct.Struct("<4sII")
+
+def fileHash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fileSignature(path: str) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def sourcePaths(configPath: str) -> Dict[str, str]:
+    with open(configPath, "r", encoding='utf-8') as f:
+        config = json.load(f)
+    paths = {"config": configPath, "qna": config["qna"]}
+    if "systemPromptTemplate" in config:
+        paths["systemPromptTemplate"] = config["systemPromptTemplate"]
+    return paths
+
+# (size, mtime) and content hash of every source file. A file whose size and mtime are the ones in known is
+# not read again and keeps its known hash, so checking an artifact does not hash the whole QnA on every load
+def sourceSignatures(configPath: str, known: Union[Dict[str, List], None] = None) -> Dict[str, List]:
+    known = known if known is not None else {}
+    signatures = {}
+    for name, path in sourcePaths(configPath).items():
+        # the stat comes before the hash, a file changed while it is hashed is hashed again next time
+        signature = fileSignature(path)
+        previous = known.get(name)
+        if previous is not None and previous[:2] == signature:
+            signatures[name] = previous
+        else:
+            signatures[name] = [*signature, fileHash(path)]
+    return signatures
+
+def sourceHashes(configPath: str, known: Union[Dict[str, List], None] = None) -> Dict[str, str]:
+    return {name: signature[2] for name, signature in sourceSignatures(configPath, known).items()}
+
+def compileArtifact(configPath: str, outputPath: Union[str, None] = None, qnaFormat: Union[str, None] = None) -> str:
+    outputPath = outputPath if outputPath is not None else os.path.splitext(configPath)[0] + ".drqa"
+    with open(configPath, "r", encoding='utf-8') as f:
+        config = json.load(f)
+    systemPromptTemplate = DEFAULT_SYSTEM_PROMPT_TEMPLATE
+    if "systemPromptTemplate" in config:
+        with open(config["systemPromptTemplate"], 'r', encoding='utf-8') as f:
+            systemPromptTemplate = f.read()
+    store = QnAStore(loadConfigQnA(config))
+    model = QnAModel(None, store, config["additionalInformation"], config["interviewee"], config["interviewer"], systemPromptTemplate=systemPromptTemplate)
+    if qnaFormat is not None:
+        model.qnaFormat = qnaFormat
+    systemMessage, properties = model.selectionPrompt()
+
+    sections = store.buffers()
+    sections["systemMessage"] = systemMessage.encode("utf-8")
+    sections["properties"] = json.dumps(properties).encode("utf-8")
+
+    header = {
+        "interviewee": model.interviewee,
+        "interviewer": model.interviewer,
+        "additionalInformation": model.additionalInformation,
+        "systemPromptTemplate": model.systemPromptTemplate,
+        "qnaFormat": model.qnaFormat,
+        "answerPreviewLength": model.answerPreviewLength,
+        "items": len(store),
+        "sources": sourceSignatures(configPath),
+        "sections": {},
+    }
+    # section offsets are relative to the end of the header, so the header can be written first
+    offset = 0
+    for name, data in sections.items():
+        header["sections"][name] = [offset, len(data)]
+        offset += (len(data) + 7) // 8 * 8
+    headerBytes = json.dumps(header).encode("utf-8")
+    headerBytes += b" " * ((-(_PREAMBLE.size + len(headerBytes))) % 8)
+
+    temporaryPath = outputPath + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        f.write(_PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, len(headerBytes)))
+        f.write(headerBytes)
+        for data in sections.values():
+            f.write(data)
+            f.write(b"\0" * ((-len(data)) % 8))
+    os.replace(temporaryPath, outputPath)
+    return outputPath
+
+class Artifact:
+    path: str
+    header: Dict
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, headerLength = _PREAMBLE.unpack_from(self._map)
+        if magic != ARTIFACT_MAGIC:
+            raise ValueError(f"{path} is not a directRetrieval artifact")
+        if version != ARTIFACT_VERSION:
+            raise ValueError(f"{path} has artifact version {version}, expected {ARTIFACT_VERSION}, compile it again")
+        self.header = json.loads(self._map[_PREAMBLE.size:_PREAMBLE.size + headerLength])
+        self._dataStart = _PREAMBLE.size + headerLength
+
+    def section(self, name: str) -> memoryview:
+        offset, length = self.header["sections"][name]
+        start = self._dataStart + offset
+        return memoryview(self._map)[start:start + length]
+
+    def isFresh(self, configPath: str) -> bool:
+        try:
+            known = self.header["sources"]
+            return sourceHashes(configPath, known) == {name: signature[2] for name, signature in known.items()}
+        except (OSError, KeyError, ValueError):
+            return False
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def store(self) -> QnAStore:
+        names = ["ids", "idOffsets", "questions", "questionOffsets", "answers", "answerOffsets", "tagTable", "tags", "tagOffsets"]
+        return QnAStore.fromBuffers({name: self.section(name) for name in names})
+
+    def precompiledPrompt(self) -> Tuple[str, memoryview]:
+        return str(self.section("systemMessage"), "utf-8"), self.section("properties")
+
+def loadArtifact(llm: LLMInterface, path: str) -> QnAModel:
+    artifact = Artifact(path)
+    header = artifact.header
+    model = QnAModel(llm, artifact.store(), header["additionalInformation"], header["interviewee"], header["interviewer"], systemPromptTemplate=header["systemPromptTemplate"])
+    model.qnaFormat = header["qnaFormat"]
+    model.answerPreviewLength = header["answerPreviewLength"]
+    # the schema JSON is only parsed when the first question needs it
+    systemMessage, properties = artifact.precompiledPrompt()
+    model.addPrecompiledPrompt(model.qnaFormat, systemMessage, properties)
+    model.artifact = artifact
+    return model
+
+# use the artifact when it was compiled from the current sources, compile it again otherwise
+def loadOrCompile(llm: LLMInterface, configPath: str, artifactPath: Union[str, None] = None) -> QnAModel:
+    artifactPath = artifactPath if artifactPath is not None else os.path.splitext(configPath)[0] + ".drqa"
+    if os.path.exists(artifactPath):
+        try:
+            artifact = Artifact(artifactPath)
+            fresh = artifact.isFresh(configPath)
+            artifact.close()
+        except ValueError:
+            fresh = False
+        if fresh:
+            return loadArtifact(llm, artifactPath)
+    compileArtifact(configPath, artifactPath)
+    return loadArtifact(llm, artifactPath)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m directRetrieval.artifact", description="Compile persona configs into artifacts loaded with QnAModel.fromArtifact")
+    parser.add_argument("configs", nargs="+")
+    parser.add_argument("--output", help="artifact path, only with a single config (default: next to the config, with a .drqa extension)")
+    parser.add_argument("--format", help="QnA rendering to precompile")
+    args = parser.parse_args()
+    assert args.output is None or len(args.configs) == 1, "--output can only be used with a single config"
+    for configPath in args.configs:
+        print(compileArtifact(configPath, args.output, args.format))
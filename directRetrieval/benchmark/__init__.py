@@ -0,0 +1,4 @@
+from .mock_server import MockLLMServer, sampleFromSchema
+from .corpus import syntheticQnA, syntheticEvaluation, writeQnAFile
+from .scenarios import runBenchmarks, measure
+from .memory import memoryBenchmark
@@ -0,0 +1,29 @@
+import sys
+import json
+import argparse
+from .scenarios import runBenchmarks, DEFAULT_SIZES
+from .memory import memoryBenchmark
+from .imports import importBenchmark
+
+parser = argparse.ArgumentParser(prog="python -m directRetrieval.benchmark", description="Measure directRetrieval's own overhead against a local mock LLM server")
+parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="number of QnA items of each synthetic corpus")
+parser.add_argument("--repeat", type=int, default=20, help="repetitions per scenario for 100 items or less, scaled down for larger corpora")
+parser.add_argument("--latency", type=float, default=0.0, help="simulated model latency in seconds")
+parser.add_argument("--evaluate-questions", type=int, default=20)
+parser.add_argument("--max-tags", type=int, default=3, help="items get between 1 and this many tags, the schema grows with their permutations")
+parser.add_argument("--memory", action="store_true", help="also measure the memory used by each QnA storage layout")
+parser.add_argument("--imports", action="store_true", help="also measure the time to import the package, with its backends loaded lazily and eagerly")
+parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+args = parser.parse_args()
+
+report = runBenchmarks(args.sizes, repeat=args.repeat, latency=args.latency, evaluateQuestions=args.evaluate_questions, maxTags=args.max_tags)
+if args.memory:
+    report["results"].extend(memoryBenchmark(args.sizes))
+if args.imports:
+    report["results"].extend(importBenchmark())
+if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,36 @@
+from typing import List, Tuple
+import random
+from ..load_qna import QnA_Item
+
+_WORDS = """about after again age answer area back because before best between book business call car case change child city
+company country course day different early education end family find first food friend game government group hand health help
+history home house idea important information interest job kind know land language large last law learn life line little local
+long market money month morning music name national need night number office old open order own part party people person place
+plan play point power problem program project question reason report research result right room school service side small social
+start state story student study system team thing time today town travel water week work world write year young""".split()
+
+_TAGS = ["personal", "work", "family", "money", "travel", "health", "education", "hobby", "history", "opinion", "future", "past"]
+
+# deterministic synthetic persona: n items with tagsPerItem tags each (a range draws a random count per item)
+def syntheticQnA(n: int, tagsPerItem: Tuple[int, int] = (1, 3), answerWords: int = 40, seed: int = 0) -> List[QnA_Item]:
+    rng = random.Random(seed)
+    items: List[QnA_Item] = []
+    for i in range(n):
+        tags = rng.sample(_TAGS, rng.randint(tagsPerItem[0], tagsPerItem[1]))
+        question = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(5, 12))).capitalize() + "?"
+        answer = " ".join(rng.choice(_WORDS) for _ in range(answerWords)).capitalize() + "."
+        items.append(QnA_Item(f"item_{i}", tags, question, answer))
+    return items
+
+# questions paired with the ID expected to answer them, usable with QnAModel.evaluate
+def syntheticEvaluation(items: List[QnA_Item], n: int, seed: int = 0) -> List[Tuple[str, str]]:
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(n):
+        qnaItem = rng.choice(items)
+        pairs.append((f"Could you tell me: {qnaItem.question.lower()}", qnaItem.ID))
+    return pairs
+
+def writeQnAFile(items: List[QnA_Item], filename: str):
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(f"{' '.join(qnaItem.tags)}\n{qnaItem.ID}\n{qnaItem.question}\n{qnaItem.answer}" for qnaItem in items))
@@ -0,0 +1,57 @@
+from typing import List, Dict
+import sys
+import json
+import statistics
+import subprocess
+
+DEFAULT_MODULES = ["directRetrieval.LLMInterfaces", "directRetrieval.qna", "directRetrieval.registry", "directRetrieval.serve"]
+HEAVY_MODULES = ["requests", "httpx", "jinja2", "llama_cpp", "ollama"]
+
+# the backends and jinja2 imported as well, what every import of the package cost before they were loaded lazily
+_EAGER = """
+import jinja2
+from directRetrieval import LLMInterfaces
+for name in ("OpenAI", "RateLimiter", "LlamaCPPServer", "LLamaCPPPool", "LLamaCPP"):
+    try:
+        getattr(LLMInterfaces, name)
+    except (ImportError, AttributeError):
+        pass
+"""
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+{eager}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+# every measurement runs in a fresh interpreter, nothing is imported yet
+def _importTime(module: str, eager: bool) -> Dict:
+    code = _PROBE.format(module=module, eager=_EAGER if eager else "", heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+def importBenchmark(modules: List[str] = DEFAULT_MODULES, repeat: int = 10) -> List[Dict]:
+    results = []
+    for module in modules:
+        measured = {}
+        for variant, eager in (("lazy", False), ("eager", True)):
+            runs = [_importTime(module, eager) for _ in range(repeat)]
+            measured[variant] = statistics.median(run["seconds"] for run in runs)
+            results.append({
+                "scenario": "import_time",
+                "module": module,
+                "variant": variant,
+                "repeat": repeat,
+                "median": measured[variant],
+                "min": min(run["seconds"] for run in runs),
+                "loaded": runs[0]["loaded"],
+            })
+        results[-2]["savingsVsEager"] = 1 - measured["lazy"] / measured["eager"] if measured["eager"] else 0.0
+    return results
+
+if __name__ == "__main__":
+    for result in importBenchmark():
+        print(json.dumps(result))
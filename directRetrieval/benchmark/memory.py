@@ -0,0 +1,51 @@
+from typing import List, Dict, Callable
+import gc
+import tracemalloc
+from ..load_qna import QnA_Item
+from ..qna_store import QnAStore
+from .corpus import syntheticQnA
+
+# QnA_Item as it was before __slots__ and tag interning, kept as the baseline of the comparison
+class _DictQnAItem:
+    def __init__(self, ID: str, tags: List[str], question: str, answer: str):
+        self.ID = ID
+        self.tags = tags
+        self.question = question
+        self.answer = answer
+
+def _allocated(build: Callable[[], object]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return current
+
+def memoryBenchmark(sizes: List[int], seed: int = 0) -> List[Dict]:
+    results = []
+    for n in sizes:
+        # keep the source strings alive outside of the measurement, only the structures built from them are counted
+        rows = [(qnaItem.ID, list(qnaItem.tags), qnaItem.question, qnaItem.answer) for qnaItem in syntheticQnA(n, seed=seed)]
+        # fresh string objects per item, like a parser produces
+        copy = lambda text: (text + ".")[:-1]
+        layouts = {
+            "dict_items": lambda: [_DictQnAItem(copy(ID), [copy(tag) for tag in tags], copy(question), copy(answer)) for ID, tags, question, answer in rows],
+            "slot_items": lambda: [QnA_Item(copy(ID), [copy(tag) for tag in tags], copy(question), copy(answer)) for ID, tags, question, answer in rows],
+            "columnar_store": lambda: QnAStore(QnA_Item(copy(ID), [copy(tag) for tag in tags], copy(question), copy(answer)) for ID, tags, question, answer in rows),
+        }
+        baseline = None
+        for layout, build in layouts.items():
+            allocated = _allocated(build)
+            baseline = baseline if baseline is not None else allocated
+            results.append({
+                "scenario": "qna_memory",
+                "layout": layout,
+                "items": n,
+                "bytes": allocated,
+                "bytesPerItem": allocated / n if n else 0.0,
+                "savingsVsDict": 1 - allocated / baseline if baseline else 0.0,
+            })
+    return results
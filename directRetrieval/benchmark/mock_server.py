@@ -0,0 +1,180 @@
+from typing import Dict, List, Union
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# fill a JSON schema with a deterministic value: the first const of every anyOf, empty strings, true booleans
+def sampleFromSchema(schema: Dict):
+    if "anyOf" in schema:
+        return sampleFromSchema(schema["anyOf"][0])
+    if "const" in schema:
+        return schema["const"]
+    schemaType = schema.get("type")
+    if schemaType == "object":
+        return {key: sampleFromSchema(value) for key, value in schema.get("properties", {}).items()}
+    if schemaType == "boolean":
+        return True
+    if schemaType in ("integer", "number"):
+        return 0
+    if schemaType == "array":
+        return []
+    return ""
+
+def _requestSchema(data: Dict) -> Union[Dict, None]:
+    # llama.cpp style: json_schema or response_format.schema, OpenAI style: response_format.json_schema.schema
+    if "json_schema" in data:
+        return data["json_schema"]
+    responseFormat = data.get("response_format")
+    if not responseFormat:
+        return None
+    if "schema" in responseFormat:
+        return responseFormat["schema"]
+    if "json_schema" in responseFormat:
+        return responseFormat["json_schema"].get("schema")
+    return None
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle's algorithm and delayed ACKs every response on a
+    # kept-alive connection would wait ~40ms, which the benchmarks would report as client overhead
+    disable_nagle_algorithm = True
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _sendJSON(self, body: Dict, status: int = 200):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path in ("/health", "/healthz"):
+            self._sendJSON({"status": "ok"})
+        else:
+            self._sendJSON({"error": "not found"}, 404)
+
+    def do_POST(self):
+        mock = self.server.mock
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with mock._lock:
+            mock.requests += 1
+        if self.path.rstrip("/").endswith("/tokenize"):
+            # whitespace tokenizer, enough to exercise the exact token estimator
+            self._sendJSON({"tokens": list(range(len(data.get("content", "").split())))})
+            return
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            self._sendJSON({"error": "not found"}, 404)
+            return
+
+        schema = _requestSchema(data)
+        content = json.dumps(sampleFromSchema(schema)) if schema is not None else mock.content
+        promptTokens = sum(len(message["content"]) for message in data.get("messages", [])) // 4
+        usage = {"prompt_tokens": promptTokens, "completion_tokens": len(content) // 4, "total_tokens": promptTokens + len(content) // 4}
+
+        if data.get("stream"):
+            self._stream(content)
+            return
+        if mock.latency:
+            time.sleep(mock.latency)
+        self._sendJSON({
+            "object": "chat.completion",
+            "model": "mock",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, content: str):
+        mock = self.server.mock
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        if mock.timeToFirstToken:
+            time.sleep(mock.timeToFirstToken)
+        chunkSize = max(1, mock.streamChunkCharacters)
+        for i in range(0, len(content), chunkSize):
+            if i and mock.tokenDelay:
+                time.sleep(mock.tokenDelay)
+            self._event({"choices": [{"index": 0, "delta": {"content": content[i:i + chunkSize]}}]})
+        self._event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _event(self, body: Dict):
+        self.wfile.write(b"data: " + json.dumps(body).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: "MockLLMServer"
+
+# OpenAI-compatible / llama.cpp server stand-in answering with canned responses after a configurable delay
+class MockLLMServer:
+    host: str
+    port: int
+    content: str
+    latency: float
+    timeToFirstToken: float
+    tokenDelay: float
+    streamChunkCharacters: int
+    requests: int
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, content: str = "0", latency: float = 0.0, timeToFirstToken: float = 0.0, tokenDelay: float = 0.0, streamChunkCharacters: int = 4):
+        self.host = host
+        self.port = port
+        self.content = content
+        self.latency = latency
+        self.timeToFirstToken = timeToFirstToken
+        self.tokenDelay = tokenDelay
+        self.streamChunkCharacters = streamChunkCharacters
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server: Union[_Server, None] = None
+        self._thread: Union[threading.Thread, None] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    def start(self) -> "MockLLMServer":
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible / llama.cpp chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    server = MockLLMServer(args.host, args.port, latency=args.latency, timeToFirstToken=args.ttft, tokenDelay=args.token_delay).start()
+    print(f"Mock server listening on {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
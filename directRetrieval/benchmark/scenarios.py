@@ -0,0 +1,151 @@
+from typing import List, Dict, Callable, Union
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+from ..qna import QnAModel
+from ..llm_utils import generate_response, async_generate_response
+from ..LLMInterfaces import LlamaCPPServer, AsyncLlamaCPPServer
+from .mock_server import MockLLMServer
+from .corpus import syntheticQnA, syntheticEvaluation
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+QUESTION = "What kind of work did you do before?"
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+    }
+
+def _repeatFor(n: int, repeat: int) -> int:
+    # keep the 10k item runs short, they dominate the suite
+    return max(1, repeat * 100 // max(100, n))
+
+def promptScenarios(model: QnAModel, repeat: int) -> List[Dict]:
+    def cold():
+        model.invalidatePromptCache()
+        model.generateQnASelectionPrompt(QUESTION)
+    results = [{"scenario": "prompt_build_cold", **measure(cold, repeat)}]
+    model.generateQnASelectionPrompt(QUESTION)
+    results.append({"scenario": "prompt_build_warm", **measure(lambda: model.generateQnASelectionPrompt(QUESTION), repeat)})
+    return results
+
+def schemaScenario(model: QnAModel, repeat: int) -> List[Dict]:
+    systemMessage, properties = model.selectionPrompt()
+    serialized = json.dumps(properties)
+    return [{
+        "scenario": "schema_size",
+        "schemaBytes": len(serialized),
+        "anyOfEntries": len(properties[model.ANSWER_KEY]["anyOf"]),
+        "systemMessageBytes": len(systemMessage.encode("utf-8")),
+        "systemMessageTokens": model.getTokenEstimator().countTokens(systemMessage),
+    }]
+
+def serializationScenario(model: QnAModel, repeat: int) -> List[Dict]:
+    messages, properties = model.generateQnASelectionPrompt(QUESTION)
+    schema = {"type": "object", "properties": properties, "required": list(properties.keys())}
+    # same payload shape as LlamaCPPServer
+    data = {"messages": messages, "response_format": {"type": "json_object", "schema": schema}, "json_schema": schema, "temperature": 0}
+    return [{"scenario": "request_serialization", "requestBytes": len(json.dumps(data)), **measure(lambda: json.dumps(data).encode("utf-8"), repeat)}]
+
+def getAnswerScenarios(model: QnAModel, server: MockLLMServer, repeat: int) -> List[Dict]:
+    syncModel = model.withLLM(LlamaCPPServer(server.url))
+    asyncModel = model.withLLM(AsyncLlamaCPPServer(server.url))
+    syncModel.getAnswer(QUESTION)
+    results = []
+    for scenario, target in (("get_answer_sync", syncModel), ("get_answer_async", asyncModel)):
+        result = measure(lambda: target.getAnswer(QUESTION), repeat)
+        # what directRetrieval adds on top of the (mocked) model latency
+        result["overheadMedian"] = result["median"] - server.latency
+        results.append({"scenario": scenario, **result})
+
+    async def asyncCall():
+        messages, properties = asyncModel.generateQnASelectionPrompt(QUESTION)
+        await async_generate_response(asyncModel.llm, messages, properties)
+    result = measure(lambda: asyncio.run(asyncCall()), repeat)
+    result["overheadMedian"] = result["median"] - server.latency
+    results.append({"scenario": "async_generate_response", **result})
+    return results
+
+def streamScenario(server: MockLLMServer, repeat: int) -> List[Dict]:
+    llm = LlamaCPPServer(server.url)
+    messages = [{"role": "user", "content": QUESTION}]
+    firstTokens = []
+    totals = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        first: Union[float, None] = None
+        for _token in generate_response(llm, messages, None, temperature=0, stream=True):
+            if first is None:
+                first = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        firstTokens.append(first if first is not None else totals[-1])
+    return [{
+        "scenario": "stream_sync",
+        "repeat": repeat,
+        "timeToFirstTokenMedian": statistics.median(firstTokens),
+        "median": statistics.median(totals),
+    }]
+
+def evaluateScenario(model: QnAModel, server: MockLLMServer, questions: int) -> List[Dict]:
+    evaluationModel = model.withLLM(LlamaCPPServer(server.url))
+    pairs = syntheticEvaluation(evaluationModel.qna, questions)
+    start = time.perf_counter()
+    evaluationModel.evaluate(pairs)
+    seconds = time.perf_counter() - start
+    return [{"scenario": "evaluate_throughput", "questions": questions, "seconds": seconds, "questionsPerSecond": questions / seconds}]
+
+def _gitCommit() -> Union[str, None]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(sizes: List[int] = DEFAULT_SIZES, repeat: int = 20, latency: float = 0.0, evaluateQuestions: int = 20, maxTags: int = 3, seed: int = 0) -> Dict:
+    results = []
+    workingDirectory = os.getcwd()
+    with MockLLMServer(content="Freelancing means working for several clients on my own schedule.", latency=latency, streamChunkCharacters=1) as server, tempfile.TemporaryDirectory() as scratch:
+        # QnAModel writes messages.txt and the interfaces print while streaming, keep both out of the way
+        os.chdir(scratch)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.extend({"items": 0, **result} for result in streamScenario(server, repeat))
+                for n in sizes:
+                    model = QnAModel(LlamaCPPServer(server.url), syntheticQnA(n, tagsPerItem=(1, maxTags), seed=seed), {}, "Cristian", "Interviewer")
+                    sizeRepeat = _repeatFor(n, repeat)
+                    sizeResults = []
+                    sizeResults.extend(promptScenarios(model, sizeRepeat))
+                    sizeResults.extend(schemaScenario(model, sizeRepeat))
+                    sizeResults.extend(serializationScenario(model, sizeRepeat))
+                    sizeResults.extend(getAnswerScenarios(model, server, sizeRepeat))
+                    sizeResults.extend(evaluateScenario(model, server, min(evaluateQuestions, sizeRepeat * 2)))
+                    results.extend({"items": n, "qnaFormat": model.qnaFormat, **result} for result in sizeResults)
+        finally:
+            os.chdir(workingDirectory)
+    return {
+        "meta": {
+            "commit": _gitCommit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "mockLatency": latency,
+            "sizes": sizes,
+            "maxTags": maxTags,
+        },
+        "results": results,
+    }
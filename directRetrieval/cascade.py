@@ -0,0 +1,164 @@
+import time
+import threading
+from typing import List, Dict, Callable
+from .load_qna import QnA_Item
+from .qna import QnAModel, DEFAULT_SYSTEM_PROMPT_TEMPLATE, overlapScore
+from .LLMInterfaces import LLMInterface
+from . import instrumentation
+
+# a confidence signal receives the model of the tier that answered, the question and the JSON response,
+# and returns a score in [0, 1]
+ConfidenceSignal = Callable[[QnAModel, str, Dict], float]
+
+def selfReportConfidence(model: QnAModel, question: str, response: Dict) -> float:
+    # trust the model's own "Is_answer_in_QnA" flag, as long as the selected item is consistent with the QnA
+    if not response.get("Is_answer_in_QnA", False):
+        return 0.0
+    selected = response.get(model.ANSWER_KEY, {})
+    try:
+        qnaItem: QnA_Item = model.qna[selected["question_number"]]
+    except (KeyError, IndexError, TypeError):
+        return 0.0
+    return 1.0 if selected.get("question", qnaItem.question) == qnaItem.question else 0.0
+
+def agreementConfidence(model: QnAModel, question: str, response: Dict) -> float:
+    # run the unconstrained simpleID prompt on the same backend and check that both selections agree
+    ID = model.responseID(response)
+    if ID == "":
+        return 0.0
+    return 1.0 if model.simpleID(question) == ID else 0.0
+
+def overlapConfidence(model: QnAModel, question: str, response: Dict) -> float:
+    # lexical retrieval score: fraction of the question words found in the selected item's question and tags
+    ID = model.responseID(response)
+    if ID == "":
+        return 0.0
+    return overlapScore(question, model.qna[response[model.ANSWER_KEY]["question_number"]])
+
+class TierStats:
+    calls: int
+    accepted: int
+    totalLatency: float
+
+    def __init__(self):
+        self.calls = 0
+        self.accepted = 0
+        self.totalLatency = 0.0
+
+    def record(self, latency: float, accepted: bool):
+        self.calls += 1
+        self.totalLatency += latency
+        if accepted:
+            self.accepted += 1
+
+    def toDict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "accepted": self.accepted,
+            "hitRate": self.accepted / self.calls if self.calls else 0.0,
+            "averageLatency": self.totalLatency / self.calls if self.calls else 0.0,
+            "totalLatency": self.totalLatency,
+        }
+
+class CascadeQnAModel(QnAModel):
+    escalationLLM: LLMInterface
+    threshold: float
+    confidence: ConfidenceSignal
+    tierStats: List[TierStats]
+
+    def __init__(
+            self,
+            llm: LLMInterface,
+            escalationLLM: LLMInterface,
+            qna: List[QnA_Item],
+            additionalInformation: Dict,
+            interviewee: str,
+            interviewer: str,
+            systemPromptTemplate: str = DEFAULT_SYSTEM_PROMPT_TEMPLATE,
+            threshold: float = 0.5,
+            confidence: ConfidenceSignal = selfReportConfidence):
+        super().__init__(llm, qna, additionalInformation, interviewee, interviewer, systemPromptTemplate=systemPromptTemplate)
+        self.escalationLLM = escalationLLM
+        self.threshold = threshold
+        self.confidence = confidence
+        self.tierStats = [TierStats(), TierStats()]
+        self._statsLock = threading.Lock()
+
+    @classmethod
+    def fromQnAModel(cls, model: QnAModel, escalationLLM: LLMInterface, threshold: float = 0.5, confidence: ConfidenceSignal = selfReportConfidence) -> "CascadeQnAModel":
+        cascade = cls.__new__(cls)
+        cascade.__dict__.update(model.__dict__)
+        cascade.escalationLLM = escalationLLM
+        cascade.threshold = threshold
+        cascade.confidence = confidence
+        cascade.tierStats = [TierStats(), TierStats()]
+        cascade._statsLock = threading.Lock()
+        return cascade
+
+    # the cascade runs on the selection response, so the ID and answer methods of QnAModel, sync and async, go
+    # through it: the cheap tier is the backend this model was built with, the expensive tier's answer is always
+    # accepted
+    def getJSONAnswer(self, question: str) -> Dict:
+        start = time.perf_counter()
+        response = super().getJSONAnswer(question)
+        accepted = self._accepted(question, response)
+        self._record(0, time.perf_counter() - start, accepted)
+        if accepted:
+            return response
+
+        start = time.perf_counter()
+        response = self.withLLM(self.escalationLLM).getJSONAnswer(question)
+        self._record(1, time.perf_counter() - start, True)
+        return response
+
+    async def getJSONAnswerAsync(self, question: str) -> Dict:
+        import asyncio
+        start = time.perf_counter()
+        response = await super().getJSONAnswerAsync(question)
+        # a signal can call the backend itself, like agreementConfidence, so it runs off the event loop
+        accepted = await asyncio.get_running_loop().run_in_executor(None, self._accepted, question, response)
+        self._record(0, time.perf_counter() - start, accepted)
+        if accepted:
+            return response
+
+        start = time.perf_counter()
+        response = await self.withLLM(self.escalationLLM).getJSONAnswerAsync(question)
+        self._record(1, time.perf_counter() - start, True)
+        return response
+
+    # a selection that does not resolve to an item, e.g. an out of range question number, is not confident
+    # whatever the signal says
+    def _accepted(self, question: str, response: Dict) -> bool:
+        try:
+            if self.confidence(self, question, response) < self.threshold:
+                return False
+            self.responseID(response)
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+
+    # kept for getStats and sent to the instrumentation hooks: a cascade_tier_<n> timing per call of a tier and a
+    # cascade_tier_<n>_accepted event per answer it gave
+    def _record(self, tier: int, latency: float, accepted: bool):
+        with self._statsLock:
+            self.tierStats[tier].record(latency, accepted)
+        instrumentation.timing(f"cascade_tier_{tier}", latency, tier=tier, accepted=accepted)
+        if accepted:
+            instrumentation.event(f"cascade_tier_{tier}_accepted", tier=tier)
+
+    def getStats(self) -> Dict:
+        with self._statsLock:
+            tiers = [stats.toDict() for stats in self.tierStats]
+        questions = tiers[0]["calls"]
+        totalLatency = sum(tier["totalLatency"] for tier in tiers)
+        return {
+            "threshold": self.threshold,
+            "questions": questions,
+            "escalationRate": tiers[1]["calls"] / questions if questions else 0.0,
+            "averageLatency": totalLatency / questions if questions else 0.0,
+            "tiers": tiers,
+        }
+
+    def resetStats(self):
+        with self._statsLock:
+            self.tierStats = [TierStats(), TierStats()]
@@ -0,0 +1,278 @@
+from typing import List, Dict, Union, Tuple
+import time
+import bisect
+import threading
+import contextvars
+import contextlib
+
+# Stages emitted by the library:
+#   get_answer, prompt_build, qna_render, schema_build, jinja_render, id_lookup    (QnAModel)
+#   generate_response                                                   (llm_utils)
+#   serialize, network, response_parse, json_parse, generate, time_to_first_token, decode   (LLM interfaces)
+#   queue_wait                                                          (LLamaCPPPool)
+# Events: prompt_cache_hit, prompt_cache_miss, retry, worker_restart
+# Hooks are only called when at least one is registered, otherwise stage() returns a shared no-op context manager.
+
+class Hook:
+    def onStageStart(self, stage: str, attributes: Dict):
+        pass
+
+    def onStageEnd(self, stage: str, seconds: float, attributes: Dict):
+        pass
+
+    # a duration measured by the library itself rather than around a block, e.g. the time to the first streamed token
+    def onTiming(self, stage: str, seconds: float, attributes: Dict):
+        pass
+
+    def onTokens(self, promptTokens: int, completionTokens: int, attributes: Dict):
+        pass
+
+    def onEvent(self, event: str, attributes: Dict):
+        pass
+
+_hooks: Tuple[Hook, ...] = ()
+enabled: bool = False
+
+def addHook(hook: Hook):
+    global _hooks, enabled
+    _hooks = _hooks + (hook,)
+    enabled = True
+
+def removeHook(hook: Hook):
+    global _hooks, enabled
+    _hooks = tuple(h for h in _hooks if h is not hook)
+    enabled = len(_hooks) > 0
+
+class _NullStage:
+    def __enter__(self) -> "_NullStage":
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, key: str, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, name: str, attributes: Dict):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> "_Stage":
+        for hook in _hooks:
+            hook.onStageStart(self.name, self.attributes)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        if excType is not None:
+            self.attributes["error"] = excType.__name__
+        for hook in _hooks:
+            hook.onStageEnd(self.name, seconds, self.attributes)
+        return False
+
+    # add an attribute known only once the stage is running, e.g. the size of a payload
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+def stage(name: str, **attributes) -> Union[_Stage, _NullStage]:
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name, attributes)
+
+def timing(name: str, seconds: float, **attributes):
+    if not enabled:
+        return
+    for hook in _hooks:
+        hook.onTiming(name, seconds, attributes)
+
+def tokens(promptTokens: int, completionTokens: int, **attributes):
+    if not enabled:
+        return
+    for hook in _hooks:
+        hook.onTokens(promptTokens, completionTokens, attributes)
+
+# "usage" fields of the responses received inside captureUsage, filled with or without hooks registered
+_capturedUsage: "contextvars.ContextVar[Union[Dict, None]]" = contextvars.ContextVar("capturedUsage", default=None)
+
+# the dict yielded is filled with the usage of the backend response received in the block. It is shared with
+# copies of the context, so a call made through asyncio.run fills it as well.
+@contextlib.contextmanager
+def captureUsage():
+    captured: Dict = {}
+    token = _capturedUsage.set(captured)
+    try:
+        yield captured
+    finally:
+        _capturedUsage.reset(token)
+
+# token counts from the OpenAI-style "usage" field of a backend response
+def usage(response: Dict, **attributes):
+    usageField = response.get("usage")
+    captured = _capturedUsage.get()
+    if usageField and captured is not None:
+        captured.update(usageField)
+    if not enabled:
+        return
+    if usageField:
+        tokens(usageField.get("prompt_tokens", 0), usageField.get("completion_tokens", 0), source="backend", **attributes)
+
+def event(name: str, **attributes):
+    if not enabled:
+        return
+    for hook in _hooks:
+        hook.onEvent(name, attributes)
+
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+class _Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+# in-memory histograms of the stage durations, plus token and event counters
+class HistogramExporter(Hook):
+    def __init__(self, buckets: List[float] = DEFAULT_BUCKETS):
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages: Dict[str, _Histogram] = {}
+        self.events: Dict[str, int] = {}
+        self.promptTokens: Dict[str, int] = {}
+        self.completionTokens: Dict[str, int] = {}
+
+    def onStageEnd(self, stage: str, seconds: float, attributes: Dict):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def onTiming(self, stage: str, seconds: float, attributes: Dict):
+        self.onStageEnd(stage, seconds, attributes)
+
+    def onTokens(self, promptTokens: int, completionTokens: int, attributes: Dict):
+        source = attributes.get("source", "estimate")
+        with self._lock:
+            self.promptTokens[source] = self.promptTokens.get(source, 0) + promptTokens
+            self.completionTokens[source] = self.completionTokens.get(source, 0) + completionTokens
+
+    def onEvent(self, event: str, attributes: Dict):
+        with self._lock:
+            self.events[event] = self.events.get(event, 0) + 1
+
+    def quantile(self, stage: str, q: float) -> Union[float, None]:
+        # upper bound of the bucket holding the q-quantile
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None or histogram.count == 0:
+                return None
+            target = q * histogram.count
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], histogram.counts):
+                cumulative += count
+                if cumulative >= target:
+                    return bound
+        return None
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                        "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], histogram.counts)),
+                    }
+                    for stage, histogram in self.stages.items()
+                },
+                "events": dict(self.events),
+                "promptTokens": dict(self.promptTokens),
+                "completionTokens": dict(self.completionTokens),
+            }
+
+# the histogram exporter rendered in the Prometheus text exposition format
+class PrometheusExporter(HistogramExporter):
+    prefix: str
+
+    def __init__(self, buckets: List[float] = DEFAULT_BUCKETS, prefix: str = "directretrieval"):
+        super().__init__(buckets)
+        self.prefix = prefix
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        prefix = self.prefix
+        lines = [
+            f"# HELP {prefix}_stage_seconds Duration of each stage of a request.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(snapshot["stages"].items()):
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        lines.append(f"# HELP {prefix}_events_total Cache hits, misses and retries.")
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for event, count in sorted(snapshot["events"].items()):
+            lines.append(f'{prefix}_events_total{{event="{event}"}} {count}')
+        lines.append(f"# HELP {prefix}_tokens_total Prompt and completion tokens, reported by the backend or estimated.")
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for kind in ("prompt", "completion"):
+            for source, count in sorted(snapshot[f"{kind}Tokens"].items()):
+                lines.append(f'{prefix}_tokens_total{{kind="{kind}",source="{source}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+# every stage becomes a span of the given OpenTelemetry tracer, nested stages become child spans
+class OpenTelemetryExporter(Hook):
+    def __init__(self, tracer):
+        # optional dependency, only needed when this exporter is used
+        from opentelemetry import trace, context
+        self._trace = trace
+        self._context = context
+        self.tracer = tracer
+        self._spans: contextvars.ContextVar[Tuple] = contextvars.ContextVar("directRetrievalSpans", default=())
+
+    def onStageStart(self, stage: str, attributes: Dict):
+        span = self.tracer.start_span(stage, attributes={key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))})
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        self._spans.set(self._spans.get() + ((span, token),))
+
+    def onStageEnd(self, stage: str, seconds: float, attributes: Dict):
+        spans = self._spans.get()
+        if not spans:
+            return
+        span, token = spans[-1]
+        self._spans.set(spans[:-1])
+        for key, value in attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                span.set_attribute(key, value)
+        span.end()
+        self._context.detach(token)
+
+    def onTiming(self, stage: str, seconds: float, attributes: Dict):
+        end = time.time_ns()
+        span = self.tracer.start_span(stage, start_time=end - int(seconds * 1e9), attributes={key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))})
+        span.end(end_time=end)
+
+    def onTokens(self, promptTokens: int, completionTokens: int, attributes: Dict):
+        span = self._trace.get_current_span()
+        span.set_attribute(f"llm.{attributes.get('source', 'estimate')}.prompt_tokens", promptTokens)
+        span.set_attribute(f"llm.{attributes.get('source', 'estimate')}.completion_tokens", completionTokens)
+
+    def onEvent(self, event: str, attributes: Dict):
+        self._trace.get_current_span().add_event(event, {key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))})
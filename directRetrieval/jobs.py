@@ -0,0 +1,213 @@
+from typing import List, Dict, Tuple, Union, Iterator, Set
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+from .registry import QnAModelRegistry
+from .LLMInterfaces import LLMInterface
+
+# Bulk answering of logged questions. Questions are read from JSONL (objects with "question" and optionally
+# "persona", or plain JSON strings) or CSV (a "question" column and optionally "persona"), deduplicated, and
+# answered through a bounded pool of concurrent workers. Every result is appended to the output JSONL as soon
+# as it is known, and the output is flushed to disk every checkpointEvery results or checkpointSeconds.
+# Running the same job again skips the questions already answered in the output, so a killed job resumes
+# where it stopped; questions that failed are tried again, their new result is appended after the old one.
+
+def readQuestions(path: str, persona: Union[str, None] = None) -> Iterator[Tuple[str, str]]:
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                question = (row.get("question") or "").strip()
+                if question:
+                    yield row.get("persona") or persona, question
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"question": record}
+            question = record.get("question", "").strip()
+            if question:
+                yield record.get("persona") or persona, question
+
+# (persona, question) of the questions already answered in an output file, after dropping a line cut short by a crash
+def completedQuestions(outputPath: str) -> Set[Tuple[str, str]]:
+    completed = set()
+    if not os.path.exists(outputPath):
+        return completed
+    with open(outputPath, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in record:
+                completed.add((record["persona"], record["question"]))
+        f.truncate(end)
+    return completed
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class BulkJob:
+    registry: QnAModelRegistry
+    inputPath: str
+    outputPath: str
+    persona: Union[str, None]
+    concurrency: int
+    checkpointEvery: int
+    checkpointSeconds: float
+    progress: bool
+
+    def __init__(self, registry: QnAModelRegistry, inputPath: str, outputPath: str, persona: Union[str, None] = None, concurrency: int = 16, checkpointEvery: int = 100, checkpointSeconds: float = 5.0, progress: bool = True):
+        self.registry = registry
+        self.inputPath = inputPath
+        self.outputPath = outputPath
+        self.persona = persona
+        self.concurrency = concurrency
+        self.checkpointEvery = checkpointEvery
+        self.checkpointSeconds = checkpointSeconds
+        self.progress = progress
+        self.stats = {"questions": 0, "unique": 0, "skipped": 0, "answered": 0, "errors": 0, "seconds": 0.0}
+
+    def pending(self) -> List[Tuple[str, str]]:
+        questions = list(readQuestions(self.inputPath, self.persona))
+        unique = list(dict.fromkeys(questions))
+        completed = completedQuestions(self.outputPath)
+        self.stats["questions"] = len(questions)
+        self.stats["unique"] = len(unique)
+        self.stats["skipped"] = sum(1 for key in unique if key in completed)
+        for persona in set(persona for persona, _ in unique):
+            if persona is None:
+                raise ValueError("Some questions have no persona, give one in the input or as the job's persona")
+            if persona not in self.registry:
+                raise ValueError(f"Unknown persona {persona!r}")
+        return [key for key in unique if key not in completed]
+
+    async def _answer(self, persona: str, question: str) -> Dict:
+        loop = asyncio.get_running_loop()
+        try:
+            model = await loop.run_in_executor(None, self.registry.get, persona)
+            model.messagesPath = None
+            response = await model.getJSONAnswerAsync(question)
+            ID = model.responseID(response)
+            return {"persona": persona, "question": question, "id": ID, "answer": model.answerByID(ID) if ID != "" else ""}
+        except Exception as exception:
+            return {"persona": persona, "question": question, "error": f"{type(exception).__name__}: {exception}"}
+
+    async def run(self) -> Dict:
+        pending = self.pending()
+        start = time.perf_counter()
+        # bounded on both sides: at most a few questions waiting for a worker and a few results waiting for the writer
+        questions: "asyncio.Queue[Union[Tuple[str, str], None]]" = asyncio.Queue(self.concurrency * 2)
+        results: "asyncio.Queue[Union[Dict, None]]" = asyncio.Queue(self.concurrency * 2)
+
+        async def produce():
+            for key in pending:
+                await questions.put(key)
+            for _ in range(self.concurrency):
+                await questions.put(None)
+
+        async def work():
+            while True:
+                key = await questions.get()
+                if key is None:
+                    break
+                await results.put(await self._answer(*key))
+
+        async def write():
+            loop = asyncio.get_running_loop()
+            unwritten = 0
+            lastCheckpoint = lastReport = time.perf_counter()
+            with open(self.outputPath, "a", encoding="utf-8") as output:
+                while True:
+                    result = await results.get()
+                    if result is None:
+                        break
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    self.stats["errors" if "error" in result else "answered"] += 1
+                    unwritten += 1
+                    now = time.perf_counter()
+                    if unwritten >= self.checkpointEvery or now - lastCheckpoint >= self.checkpointSeconds:
+                        output.flush()
+                        await loop.run_in_executor(None, os.fsync, output.fileno())
+                        unwritten = 0
+                        lastCheckpoint = now
+                    if self.progress and now - lastReport >= 1.0:
+                        self._report(len(pending), now - start)
+                        lastReport = now
+                output.flush()
+                os.fsync(output.fileno())
+
+        async def finish():
+            await asyncio.gather(produce(), *[work() for _ in range(self.concurrency)])
+            await results.put(None)
+
+        writer = asyncio.create_task(write())
+        finishing = asyncio.create_task(finish())
+        try:
+            # the writer is watched too, when it fails the workers would otherwise wait forever on the full results queue
+            done, _ = await asyncio.wait([finishing, writer], return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            finishing.cancel()
+            writer.cancel()
+            await asyncio.gather(finishing, writer, return_exceptions=True)
+        self.stats["seconds"] = time.perf_counter() - start
+        if self.progress:
+            self._report(len(pending), self.stats["seconds"])
+            print(file=sys.stderr)
+        return self.stats
+
+    def _report(self, total: int, seconds: float):
+        done = self.stats["answered"] + self.stats["errors"]
+        rate = done / seconds if seconds > 0 else 0.0
+        eta = _duration((total - done) / rate) if rate > 0 else "?"
+        print(f"\r{done}/{total} questions, {rate:.1f}/s, ETA {eta}, {self.stats['errors']} errors", end="", file=sys.stderr, flush=True)
+
+def runJob(llm: LLMInterface, configDirectory: str, inputPath: str, outputPath: str, persona: Union[str, None] = None, concurrency: int = 16, **options) -> Dict:
+    registry = QnAModelRegistry(llm, configDirectory)
+    return asyncio.run(BulkJob(registry, inputPath, outputPath, persona, concurrency, **options).run())
+
+if __name__ == "__main__":
+    import argparse
+    from .serve import ReplicaSet
+    from .LLMInterfaces import AsyncLlamaCPPServer
+    parser = argparse.ArgumentParser(prog="python -m directRetrieval.jobs", description="Answer a file of questions, resuming from the output of an earlier run")
+    parser.add_argument("input", help="questions as JSONL or CSV")
+    parser.add_argument("output", help="results as JSONL, appended to")
+    personas = parser.add_mutually_exclusive_group(required=True)
+    personas.add_argument("--config-dir", help="directory of persona configs, questions name their persona")
+    personas.add_argument("--config", help="a single persona config, used for every question")
+    parser.add_argument("--persona", help="persona of the questions that do not name one")
+    parser.add_argument("--url", action="append", default=[], help="llama.cpp server chat completions URL, repeat for several replicas")
+    parser.add_argument("--openai", action="store_true", help="use the OpenAI API with OPENAI_API_KEY instead of llama.cpp servers")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="results between two flushes of the output to disk")
+    parser.add_argument("--checkpoint-seconds", type=float, default=5.0)
+    parser.add_argument("--artifacts", action="store_true", help="load personas through compiled artifacts")
+    args = parser.parse_args()
+
+    if args.openai:
+        from .LLMInterfaces import OpenAI
+        llm = OpenAI(os.environ["OPENAI_API_KEY"])
+    else:
+        llm = ReplicaSet([AsyncLlamaCPPServer(url) for url in args.url or ["http://localhost:8080/v1/chat/completions"]])
+    configDirectory, persona = args.config_dir, args.persona
+    if args.config is not None:
+        configDirectory = os.path.dirname(args.config) or "."
+        persona = os.path.splitext(os.path.basename(args.config))[0]
+    registry = QnAModelRegistry(llm, configDirectory, useArtifacts=args.artifacts)
+    job = BulkJob(registry, args.input, args.output, persona, args.concurrency, args.checkpoint_every, args.checkpoint_seconds)
+    stats = asyncio.run(job.run())
+    print(json.dumps(stats))
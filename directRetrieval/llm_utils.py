@@ -1,7 +1,6 @@
 from typing import List, Dict, Union, Generator, AsyncGenerator
-import asyncio
 from .LLMInterfaces import AsyncLLMInterface, LLMInterface
-from .LLMInterfaces.LLamaCPPServer import LlamaCPPServer, AsyncLlamaCPPServer
+from . import instrumentation
 
 def generate_response(
     llmInterface: LLMInterface,
@@ -10,25 +9,27 @@ def generate_response(
     temperature: int = 0,
     stream: bool = False
 ) -> Union[Dict, str, Generator[str, None, None]]:
-    if isinstance(llmInterface, AsyncLLMInterface):
-        if stream:
-            raise Exception("Stream is not supported for async interfaces as a sync generator, use async_generate_response instead")
-            def stream_response() -> Generator[str, None, None]:
-                async_generator_ = asyncio.run(llmInterface.getResponse(messages, properties, temperature, stream))
-                print(async_generator_)
-                # gen = async_generator()
-                while True:
-                    try:
-                        # TODO fix, this ends the stream after the first token
-                        yield asyncio.run(async_generator_.__anext__())
-                    except StopAsyncIteration:
-                        print("Stream ended")
-                        break
-            return stream_response()
+    with instrumentation.stage("generate_response", interface=type(llmInterface).__name__, stream=stream):
+        if isinstance(llmInterface, AsyncLLMInterface):
+            import asyncio
+            if stream:
+                raise Exception("Stream is not supported for async interfaces as a sync generator, use async_generate_response instead")
+                def stream_response() -> Generator[str, None, None]:
+                    async_generator_ = asyncio.run(llmInterface.getResponse(messages, properties, temperature, stream))
+                    print(async_generator_)
+                    # gen = async_generator()
+                    while True:
+                        try:
+                            # TODO fix, this ends the stream after the first token
+                            yield asyncio.run(async_generator_.__anext__())
+                        except StopAsyncIteration:
+                            print("Stream ended")
+                            break
+                return stream_response()
+            else:
+                return asyncio.run(llmInterface.getResponse(messages, properties, temperature, stream))
         else:
-            return asyncio.run(llmInterface.getResponse(messages, properties, temperature, stream))
-    else:
-        return llmInterface.getResponse(messages, properties, temperature, stream)
+            return llmInterface.getResponse(messages, properties, temperature, stream)
 
 async def async_generate_response(
     llmInterface: AsyncLLMInterface,
@@ -37,18 +38,20 @@ async def async_generate_response(
     temperature: int = 0,
     stream: bool = False
 ) -> Union[Union[Dict, str], AsyncGenerator]:
-    if stream:
-        async def stream_response() -> AsyncGenerator:
-            async_generator = await llmInterface.getResponse(messages, properties, temperature, stream)
-            async for token in async_generator:
-                yield token
-        return stream_response()
-    else:
-        response = await llmInterface.getResponse(messages, properties, temperature)
-        return response
+    with instrumentation.stage("generate_response", interface=type(llmInterface).__name__, stream=stream):
+        if stream:
+            async def stream_response() -> AsyncGenerator:
+                async_generator = await llmInterface.getResponse(messages, properties, temperature, stream)
+                async for token in async_generator:
+                    yield token
+            return stream_response()
+        else:
+            response = await llmInterface.getResponse(messages, properties, temperature)
+            return response
     
 
 if __name__ == "__main__":
+    from .LLMInterfaces import LlamaCPPServer, AsyncLlamaCPPServer
     url_ = "http://localhost:8080/v1/chat/completions"
     llamaServer = LlamaCPPServer(url_)
 
@@ -1,14 +1,21 @@
 import os
-from typing import List
+import sys
+import struct
+import threading
+from array import array
+from typing import List, Dict, Iterable, Iterator, Tuple, Union, Sequence
 
 class QnA_Item:
+    # no per-instance __dict__, personas can hold many thousands of items
+    __slots__ = ("ID", "tags", "question", "answer")
     ID: str
     tags: List[str]
     question: str
     answer: str
     def __init__(self, ID: str, tags: List[str], question: str, answer: str):
         self.ID = ID
-        self.tags = tags
+        # the same few tags repeat across items, share a single string for each
+        self.tags = [sys.intern(tag) for tag in tags]
         self.question = question
         self.answer = answer
 
@@ -18,48 +25,293 @@ class QnA_Item:
     
     @staticmethod
     def from_raw(raw: str) -> "QnA_Item":
-        qna_lines = raw.split("\n")
+        # leading lines are kept, an empty first line is an item without tags
+        qna_lines = [line.rstrip("\r") for line in raw.rstrip("\r\n").split("\n")]
         question = qna_lines[2]
         ID = qna_lines[1]
         tags = qna_lines[0].split(" ")
         answers = qna_lines[3:]
-        return QnA_Item(ID, tags, question, answers[0])
+        # answers spanning several lines are kept whole
+        return QnA_Item(ID, tags, question, "\n".join(answers))
 
     def copy(self) -> "QnA_Item":
         return QnA_Item(self.ID, self.tags, self.question, self.answer)
 
 
+# items of a .qna file as (start, end, lines), with start and end byte offsets. Items are separated by a blank
+# line, like splitting the text on "\n\n": a second blank line is the empty tags line of the next item. Segments
+# without any content, such as the blank lines at the end of the file, are not items.
+def _qna_segments(file) -> Iterator[Tuple[int, int, List[bytes]]]:
+    position = 0
+    start = 0
+    end = 0
+    lines: List[bytes] = []
+    # whether the newline ending the previous line can start a separator, it cannot when it ended one
+    newlineFree = False
+    for line in file:
+        content = line.rstrip(b"\r\n")
+        if not content and newlineFree:
+            if any(segmentLine.strip() for segmentLine in lines):
+                yield start, end, lines
+            lines = []
+            newlineFree = False
+        else:
+            if not lines:
+                start = position
+            lines.append(content)
+            end = position + len(content)
+            newlineFree = line.endswith(b"\n")
+        position += len(line)
+    if any(segmentLine.strip() for segmentLine in lines):
+        yield start, end, lines
+
+# yield (start, end) byte offsets of every item of a .qna file
+def iter_qna_offsets(file) -> Iterator[Tuple[int, int]]:
+    for start, end, _ in _qna_segments(file):
+        yield start, end
+
+# parse a .qna file one item at a time, without reading it whole
+def iter_qna_OOP(filename: str) -> Iterator[QnA_Item]:
+    with open(filename, 'rb') as file:
+        for _, _, lines in _qna_segments(file):
+            yield QnA_Item.from_raw(b"\n".join(lines).decode("utf-8"))
+
 def load_qna(filename):
     # Load the QnA pairs from the file
     qna = []
-    with open(filename, 'r') as file:
-        text = file.read()
-        qnas_raw = text.split("\n\n")
-        for i, qna_raw in enumerate(qnas_raw):
-            qna_lines = qna_raw.split("\n")
-            question = qna_lines[2]
-            ID = qna_lines[1]
-            tags = qna_lines[0]
-            answers = qna_lines[3:]
-            qna.append({
-                "tags": tags,
-                "question": question,
-                # "answers": answers, TODO: Add support for multiple answers
-                "answer": answers[0],
-                "question_number": i+1,
-                "ID": ID
-            })
+    for i, qnaItem in enumerate(iter_qna_OOP(filename)):
+        qna.append({
+            "tags": " ".join(qnaItem.tags),
+            "question": qnaItem.question,
+            # "answers": answers, TODO: Add support for multiple answers
+            "answer": qnaItem.answer,
+            "question_number": i+1,
+            "ID": qnaItem.ID
+        })
     return qna
 
 def load_qna_OOP(filename: str):
-    qna: List[QnA_Item] = []
-    with open(filename, 'r') as file:
-        text = file.read()
-        qnas_raw = text.split("\n\n")
-        for i, qna_raw in enumerate(qnas_raw):
-            qna.append(QnA_Item.from_raw(qna_raw))
+    qna: List[QnA_Item] = list(iter_qna_OOP(filename))
     return qna
 
+# index file layout: header, then (start, end) offset pairs as unsigned 64 bit integers, then the IDs separated by newlines
+_INDEX_MAGIC = b"DRQI"
+_INDEX_VERSION = 2
+_INDEX_HEADER = struct.Struct("<4sIQQQ")
+
+def qna_index_path(filename: str) -> str:
+    return filename + ".idx"
+
+def build_qna_index(filename: str, indexPath: Union[str, None] = None) -> str:
+    indexPath = indexPath if indexPath is not None else qna_index_path(filename)
+    offsets = array("Q")
+    IDs: List[bytes] = []
+    with open(filename, 'rb') as file:
+        for start, end in iter_qna_offsets(file):
+            offsets.append(start)
+            offsets.append(end)
+        # the ID is the second line of every item
+        for i in range(0, len(offsets), 2):
+            file.seek(offsets[i])
+            file.readline()
+            IDs.append(file.readline().rstrip(b"\r\n"))
+    if array("Q", [1]).tobytes()[0] != 1:
+        offsets.byteswap()
+    stat = os.stat(filename)
+    temporaryPath = indexPath + ".tmp"
+    with open(temporaryPath, 'wb') as index:
+        index.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(IDs)))
+        index.write(offsets.tobytes())
+        index.write(b"\n".join(IDs))
+    os.replace(temporaryPath, indexPath)
+    return indexPath
+
+# random access view over a .qna file: items are parsed on demand, using a persisted offset index. The file is
+# read rather than memory mapped: the .qna file is edited by hand, and a mapped file truncated under a reader
+# kills the process with SIGBUS. Before reading, the file is checked against the size and modification time
+# the index was built for, and the index is built again when it changed.
+class LazyQnA(Sequence[QnA_Item]):
+    filename: str
+    indexPath: str
+    # incremented every time the file is indexed again, part of the prompt cache key of QnAModel like EditableQnA's
+    version: int
+
+    def __init__(self, filename: str, indexPath: Union[str, None] = None, rebuild: bool = False):
+        self.filename = filename
+        self.indexPath = indexPath if indexPath is not None else qna_index_path(filename)
+        self._lock = threading.RLock()
+        self._file = None
+        self.version = -1
+        self._load(rebuild)
+
+    def _load(self, rebuild: bool = False):
+        if rebuild or not self._indexIsFresh():
+            build_qna_index(self.filename, self.indexPath)
+        with open(self.indexPath, 'rb') as index:
+            data = index.read()
+        _, _, size, mtime, count = _INDEX_HEADER.unpack_from(data)
+        offsetsEnd = _INDEX_HEADER.size + 16 * count
+        self._offsets = array("Q")
+        self._offsets.frombytes(data[_INDEX_HEADER.size:offsetsEnd])
+        if array("Q", [1]).tobytes()[0] != 1:
+            self._offsets.byteswap()
+        self._IDsBlob = data[offsetsEnd:]
+        self._IDs: Union[Dict[str, int], None] = None
+        self._count = count
+        self._signature = (size, mtime)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.filename, 'rb')
+        self.version += 1
+
+    def _indexIsFresh(self) -> bool:
+        try:
+            with open(self.indexPath, 'rb') as index:
+                magic, version, size, mtime, _ = _INDEX_HEADER.unpack(index.read(_INDEX_HEADER.size))
+        except (OSError, struct.error):
+            return False
+        stat = os.stat(self.filename)
+        return magic == _INDEX_MAGIC and version == _INDEX_VERSION and size == stat.st_size and mtime == stat.st_mtime_ns
+
+    # index the file again if it changed since it was indexed
+    def refresh(self) -> bool:
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # replaced by a rename in progress, keep reading the open file
+            return False
+        if (stat.st_size, stat.st_mtime_ns) == self._signature:
+            return False
+        with self._lock:
+            if (stat.st_size, stat.st_mtime_ns) != self._signature:
+                self._load()
+        return True
+
+    def __len__(self) -> int:
+        self.refresh()
+        return self._count
+
+    def _read(self, i: int) -> str:
+        with self._lock:
+            start, end = self._offsets[2 * i], self._offsets[2 * i + 1]
+            assert self._file is not None
+            self._file.seek(start)
+            data = self._file.read(end - start)
+        if len(data) != end - start:
+            # the file was cut short after the last check
+            raise IndexError("QnA file changed while being read")
+        return data.decode("utf-8")
+
+    def raw(self, i: int) -> str:
+        self.refresh()
+        return self._read(i)
+
+    def _item(self, i: int) -> QnA_Item:
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("QnA index out of range")
+        return QnA_Item.from_raw(self._read(i))
+
+    def __getitem__(self, i):
+        self.refresh()
+        if isinstance(i, slice):
+            return [self._item(j) for j in range(*i.indices(self._count))]
+        return self._item(i)
+
+    # checks the file once, not for every item
+    def __iter__(self) -> Iterator[QnA_Item]:
+        self.refresh()
+        for i in range(self._count):
+            yield self._item(i)
+
+    def indexOf(self, ID: str) -> int:
+        self.refresh()
+        if self._IDs is None:
+            self._IDs = {ID: i for i, ID in enumerate(self._IDsBlob.decode("utf-8").split("\n"))} if self._count else {}
+        return self._IDs[ID]
+
+    def getByID(self, ID: str) -> QnA_Item:
+        return self._item(self.indexOf(ID))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "LazyQnA":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# QnA edited in place. Every item keeps the question number it was given, so numbers already used in
+# prompts stay valid when other items are added or removed. Indexing takes a question number and
+# iteration yields the items in order, like a list whose items are never shifted.
+class EditableQnA:
+    # incremented on every change, part of the prompt cache key of QnAModel
+    version: int
+    nextNumber: int
+
+    def __init__(self, items: Iterable[QnA_Item] = ()):
+        self._items: Dict[int, QnA_Item] = {}
+        self._numbers: Dict[str, int] = {}
+        self.version = 0
+        self.nextNumber = 0
+        for qnaItem in items:
+            self._items[self.nextNumber] = qnaItem
+            self._numbers[qnaItem.ID] = self.nextNumber
+            self.nextNumber += 1
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[QnA_Item]:
+        return iter(list(self._items.values()))
+
+    def __getitem__(self, number: int) -> QnA_Item:
+        try:
+            return self._items[number]
+        except KeyError:
+            raise IndexError(f"No QnA item with question number {number}") from None
+
+    # (question_number, item) pairs, in order
+    def entries(self) -> List[Tuple[int, QnA_Item]]:
+        return list(self._items.items())
+
+    def indexOf(self, ID: str) -> int:
+        return self._numbers[ID]
+
+    def getByID(self, ID: str) -> QnA_Item:
+        return self._items[self._numbers[ID]]
+
+    def add(self, qnaItem: QnA_Item) -> int:
+        if qnaItem.ID in self._numbers:
+            raise ValueError(f"QnA already has an item with ID {qnaItem.ID!r}")
+        number = self.nextNumber
+        self._items[number] = qnaItem
+        self._numbers[qnaItem.ID] = number
+        self.nextNumber += 1
+        self.version += 1
+        return number
+
+    # replace the item with the given ID, the new item may have another ID
+    def update(self, ID: str, qnaItem: QnA_Item) -> int:
+        number = self._numbers[ID]
+        if qnaItem.ID != ID:
+            if qnaItem.ID in self._numbers:
+                raise ValueError(f"QnA already has an item with ID {qnaItem.ID!r}")
+            del self._numbers[ID]
+            self._numbers[qnaItem.ID] = number
+        self._items[number] = qnaItem
+        self.version += 1
+        return number
+
+    def remove(self, ID: str) -> QnA_Item:
+        number = self._numbers.pop(ID)
+        self.version += 1
+        return self._items.pop(number)
+
 if __name__ == "__main__":
     filename = "william1.qna"
     test_qna = load_qna(filename)
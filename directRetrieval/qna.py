@@ -1,10 +1,15 @@
+import re
 import json
+import time
+import hashlib
 import itertools
-from typing import List, Dict
-import jinja2
-from .load_qna import load_qna_OOP, QnA_Item
-from .llm_utils import generate_response
-from .LLMInterfaces import LLMInterface, LlamaCPPServer, AsyncLlamaCPPServer, OpenAI, OpenAISync
+from typing import List, Dict, Tuple, Union, Sequence, AsyncIterator
+from .load_qna import load_qna_OOP, QnA_Item, LazyQnA, EditableQnA
+from .qna_store import QnAStore
+from .llm_utils import generate_response, async_generate_response
+from .tokens import TokenEstimator, tokenEstimatorFor
+from . import instrumentation
+from .LLMInterfaces import LLMInterface, AsyncLLMInterface
 
 DEFAULT_SYSTEM_PROMPT_TEMPLATE = """You will be shown a list of questions that {interviewee} answered before (QnA). Your task will be to select the most relevant item from the QnA to answer that question. If the question already exists in the QnA, you should select it. If not, you should select the most relevant question and answer pair that can be used to answer the given question.
 
@@ -30,6 +35,206 @@ Use the following information to understand the question if needed:
 {% endif %}
 """
 
+# renderings of the QnA listing, from the most to the least detailed:
+# "json" pretty printed JSON, "compact" minified JSON, "table_answers" one "question_number|tags|question|answer" line
+# per item with truncated answers, "questions" minified JSON without answers and "table" "question_number|tags|question" lines
+QNA_FORMATS = ["json", "compact", "table_answers", "questions", "table"]
+# renderings tried in order when the prompt exceeds the context budget
+BUDGET_FALLBACK_FORMATS = ["json", "compact", "table_answers", "table"]
+DEFAULT_QNA_FORMAT = "compact"
+DEFAULT_ANSWER_PREVIEW_LENGTH = 80
+# counts usage when the backend reports none and no context budget asks for exact counts
+_APPROXIMATE_TOKENS = TokenEstimator()
+
+def _tableCell(text: str) -> str:
+    return text.replace("\r", " ").replace("\n", " ").replace("|", "/")
+
+def _itemObject(questionNumber: int, qnaItem: QnA_Item, withAnswer: bool = True) -> Dict:
+    itemObject = {
+        "tags": " ".join(qnaItem.tags),
+        "question": qnaItem.question,
+        "question_number": questionNumber,
+    }
+    if withAnswer:
+        itemObject["answer"] = qnaItem.answer
+    return itemObject
+
+# the entry of a single item in a rendering, joinQnA assembles the entries into the full listing
+def renderQnAItem(questionNumber: int, qnaItem: QnA_Item, qnaFormat: str = "json", answerPreviewLength: int = DEFAULT_ANSWER_PREVIEW_LENGTH) -> str:
+    if qnaFormat == "json":
+        # indented one level, as an element of the top level list
+        return "  " + json.dumps(_itemObject(questionNumber, qnaItem), indent=2).replace("\n", "\n  ")
+    elif qnaFormat == "compact":
+        return json.dumps(_itemObject(questionNumber, qnaItem), separators=(",", ":"), ensure_ascii=False)
+    elif qnaFormat == "questions":
+        # selection only needs the questions, the answers are looked up afterwards
+        return json.dumps(_itemObject(questionNumber, qnaItem, withAnswer=False), separators=(",", ":"), ensure_ascii=False)
+    elif qnaFormat == "table":
+        return f"{questionNumber}|{_tableCell(' '.join(qnaItem.tags))}|{_tableCell(qnaItem.question)}"
+    elif qnaFormat == "table_answers":
+        answer = qnaItem.answer
+        if len(answer) > answerPreviewLength:
+            answer = answer[:answerPreviewLength].rstrip() + "..."
+        return f"{questionNumber}|{_tableCell(' '.join(qnaItem.tags))}|{_tableCell(qnaItem.question)}|{_tableCell(answer)}"
+    raise ValueError(f"Unknown QnA format: {qnaFormat}")
+
+def joinQnA(fragments: List[str], qnaFormat: str = "json") -> str:
+    if qnaFormat == "json":
+        return "[\n" + ",\n".join(fragments) + "\n]" if fragments else "[]"
+    elif qnaFormat in ("compact", "questions"):
+        return "[" + ",".join(fragments) + "]"
+    elif qnaFormat == "table":
+        return "\n".join(["question_number|tags|question"] + fragments)
+    elif qnaFormat == "table_answers":
+        return "\n".join(["question_number|tags|question|answer"] + fragments)
+    raise ValueError(f"Unknown QnA format: {qnaFormat}")
+
+def renderQnA(entries: List[Tuple[int, QnA_Item]], qnaFormat: str = "json", answerPreviewLength: int = DEFAULT_ANSWER_PREVIEW_LENGTH) -> str:
+    return joinQnA([renderQnAItem(questionNumber, qnaItem, qnaFormat, answerPreviewLength) for questionNumber, qnaItem in entries], qnaFormat)
+
+# selection schema entries of an item, one per order of its tags
+def schemaEnums(questionNumber: int, qnaItem: QnA_Item) -> List[Dict]:
+    return [
+        {
+            "tags": " ".join(perm),
+            "question": qnaItem.question,
+            "question_number": questionNumber,
+        }
+        for perm in itertools.permutations(qnaItem.tags)]
+
+def _schemaChoices(questionNumber: int, qnaItem: QnA_Item) -> List[Dict]:
+    return [{"const": qnaEnum} for qnaEnum in schemaEnums(questionNumber, qnaItem)]
+
+# rendered entries and schema choices of items, keyed by the item's number and content, so rebuilding a prompt
+# only renders the items that are new or different. The entries of a whole EditableQnA are kept, edits patch them;
+# for other QnAs the whole prompt is cached joined by QnAModel, and only up to maxEntries entries of the subsets
+# rendered for a context budget are kept, least recently used first out
+class FragmentCache:
+    maxEntries: int = 1024
+
+    def __init__(self):
+        # (qnaFormat, answerPreviewLength) -> item key -> rendered entry
+        self.rendered: Dict[Tuple, Dict[Tuple, str]] = {}
+        self.choices: Dict[Tuple, List[Dict]] = {}
+        # entries of an EditableQnA by question number and in its order, patched on every edit with itemChanged
+        self.numbered: Dict[Tuple, Dict[int, str]] = {}
+        self.numberedChoices: Dict[int, List[Dict]] = {}
+        self.numberedQnA: Union[EditableQnA, None] = None
+        self.numberedVersion = -1
+        self.hits = 0
+        self.misses = 0
+
+    # the content is kept as a digest, the keys would otherwise hold a second reference to every question and answer
+    @staticmethod
+    def key(questionNumber: int, qnaItem: QnA_Item) -> Tuple:
+        content = "\0".join([qnaItem.question, qnaItem.answer, *qnaItem.tags]).encode()
+        return (questionNumber, qnaItem.ID, hashlib.blake2b(content, digest_size=16).digest())
+
+    def copy(self) -> "FragmentCache":
+        fragments = FragmentCache()
+        fragments.rendered = {rendering: dict(entries) for rendering, entries in self.rendered.items()}
+        fragments.choices = dict(self.choices)
+        fragments.numbered = {rendering: dict(entries) for rendering, entries in self.numbered.items()}
+        fragments.numberedChoices = dict(self.numberedChoices)
+        fragments.numberedQnA = self.numberedQnA
+        fragments.numberedVersion = self.numberedVersion
+        return fragments
+
+    # with complete=True the entries are the whole QnA, and entries of items no longer in it are dropped.
+    # With keep=False kept entries are reused but none are added
+    def build(self, entries: List[Tuple[int, QnA_Item]], qnaFormat: str, answerPreviewLength: int, complete: bool = False, keep: bool = True) -> Tuple[List[str], List[Dict]]:
+        rendering = (qnaFormat, answerPreviewLength)
+        rendered = self.rendered.get(rendering, {})
+        choices = self.choices
+        keptRendered = {} if complete else rendered
+        keptChoices = {} if complete else choices
+        fragments = []
+        qnaChoices = []
+        hits = 0
+        for questionNumber, qnaItem in entries:
+            key = self.key(questionNumber, qnaItem)
+            fragment = rendered.get(key)
+            if fragment is None:
+                fragment = renderQnAItem(questionNumber, qnaItem, qnaFormat, answerPreviewLength)
+            else:
+                hits += 1
+            itemChoices = choices.get(key)
+            if itemChoices is None:
+                itemChoices = _schemaChoices(questionNumber, qnaItem)
+            if keep:
+                if not complete:
+                    # moved to the end, the oldest entries are dropped first
+                    keptRendered.pop(key, None)
+                    keptChoices.pop(key, None)
+                keptRendered[key] = fragment
+                keptChoices[key] = itemChoices
+            fragments.append(fragment)
+            qnaChoices.extend(itemChoices)
+        if keep:
+            if not complete:
+                for kept in (keptRendered, keptChoices):
+                    for key in list(itertools.islice(kept, max(0, len(kept) - self.maxEntries))):
+                        del kept[key]
+            self.rendered[rendering] = keptRendered
+            self.choices = keptChoices
+        self.hits += hits
+        self.misses += len(entries) - hits
+        return fragments, qnaChoices
+
+    # the whole of an EditableQnA: after edits made through itemChanged, only joins the entries kept by number
+    def buildEditable(self, qna: EditableQnA, qnaFormat: str, answerPreviewLength: int) -> Tuple[List[str], List[Dict]]:
+        rendering = (qnaFormat, answerPreviewLength)
+        if self.numberedQnA is not qna or self.numberedVersion != qna.version:
+            self.numbered = {}
+            self.numberedQnA = qna
+            self.numberedVersion = qna.version
+        numbered = self.numbered.get(rendering)
+        if numbered is None:
+            entries = qna.entries()
+            fragments, _ = self.build(entries, qnaFormat, answerPreviewLength, complete=True)
+            numbered = self.numbered[rendering] = {questionNumber: fragment for (questionNumber, _), fragment in zip(entries, fragments)}
+            self.numberedChoices = {questionNumber: self.choices[self.key(questionNumber, qnaItem)] for questionNumber, qnaItem in entries}
+        else:
+            self.hits += len(numbered)
+        return list(numbered.values()), list(itertools.chain.from_iterable(self.numberedChoices.values()))
+
+    # call after an edit of the EditableQnA, with the new item at that number or None when it was removed
+    def itemChanged(self, qna: EditableQnA, questionNumber: int, qnaItem: Union[QnA_Item, None]):
+        if self.numberedQnA is not qna or self.numberedVersion != qna.version - 1:
+            # not built yet or edited without going through here, buildEditable starts over
+            self.numberedQnA = None
+            return
+        self.numberedVersion = qna.version
+        for (qnaFormat, answerPreviewLength), numbered in self.numbered.items():
+            if qnaItem is None:
+                del numbered[questionNumber]
+            else:
+                numbered[questionNumber] = renderQnAItem(questionNumber, qnaItem, qnaFormat, answerPreviewLength)
+                self.misses += 1
+        if qnaItem is None:
+            del self.numberedChoices[questionNumber]
+        else:
+            self.numberedChoices[questionNumber] = _schemaChoices(questionNumber, qnaItem)
+
+_WORD_RE = re.compile(r"\w+")
+
+# fraction of the question words found in the item's question and tags
+def overlapScore(question: str, qnaItem: QnA_Item) -> float:
+    questionWords = set(_WORD_RE.findall(question.lower()))
+    if not questionWords:
+        return 0.0
+    itemWords = set(_WORD_RE.findall((qnaItem.question + " " + " ".join(qnaItem.tags)).lower()))
+    return len(questionWords & itemWords) / len(questionWords)
+
+# "lazyLoad": true in a config keeps the items on disk and parses them on demand through an offset index,
+# "columnar": true keeps them in memory in packed columns
+def loadConfigQnA(config: Dict) -> Sequence[QnA_Item]:
+    if config.get("lazyLoad", False):
+        return LazyQnA(config["qna"])
+    if config.get("columnar", False):
+        return QnAStore.fromFile(config["qna"])
+    return load_qna_OOP(config["qna"])
+
 class QnAModel:
     ANSWER_KEY: str = "Question_and_Answer_From_QnA"
     llm: LLMInterface
@@ -39,6 +244,17 @@ class QnAModel:
     interviewee: str
     interviewer: str
     configPath: str
+    # rendering of the QnA listing in the prompt, one of QNA_FORMATS
+    qnaFormat: str
+    # answers longer than this are truncated by the "table_answers" rendering
+    answerPreviewLength: int
+    # maximum prompt tokens, when set cheaper renderings are used automatically to stay under it
+    contextBudget: Union[int, None]
+    tokenEstimator: Union[TokenEstimator, None]
+    # rendering, number of listed items and estimated prompt/completion tokens of the last call
+    lastUsage: Dict
+    # the last prompt is written there for debugging, None to not write it (e.g. when serving)
+    messagesPath: Union[str, None]
 
     def __init__(self, llm: LLMInterface, qna: List[QnA_Item], additionalInformation: Dict, interviewee: str, interviewer: str, systemPromptTemplate: str = DEFAULT_SYSTEM_PROMPT_TEMPLATE):
         self.llm = llm
@@ -48,60 +264,184 @@ class QnAModel:
         self.interviewee = interviewee
         self.interviewer = interviewer
         self.configPath = ""
+        self.qnaFormat = DEFAULT_QNA_FORMAT
+        self.answerPreviewLength = DEFAULT_ANSWER_PREVIEW_LENGTH
+        self.contextBudget = None
+        self.tokenEstimator = None
+        self.lastUsage = {}
+        self.messagesPath = "messages.txt"
+        self._promptCache = {}
+        self._precompiledPrompts = {}
+        self._fragments = FragmentCache()
 
     @classmethod
     def fromConfigFile(cls, llm: LLMInterface, configPath: str) -> "QnAModel":
         with open(configPath, "r", encoding='utf-8') as f:
             config = json.load(f)
-        if "systemPromptTemplate" not in config:
-            return QnAModel(llm, load_qna_OOP(config["qna"]), config["additionalInformation"], config["interviewee"], config["interviewer"])
-        else:
-            return QnAModel(llm, load_qna_OOP(config["qna"]), config["additionalInformation"], config["interviewee"], config["interviewer"], systemPromptTemplate=open(config["systemPromptTemplate"], 'r', encoding='utf-8').read())
+        model = cls.fromConfig(llm, config)
+        model.configPath = configPath
+        return model
     
     @classmethod
     def fromConfig(cls, llm: LLMInterface, config: Dict) -> "QnAModel":
         if "systemPromptTemplate" not in config:
-            return QnAModel(llm, load_qna_OOP(config["qna"]), config["additionalInformation"], config["interviewee"], config["interviewer"])
+            return QnAModel(llm, loadConfigQnA(config), config["additionalInformation"], config["interviewee"], config["interviewer"])
         else:
-            return QnAModel(llm, load_qna_OOP(config["qna"]), config["additionalInformation"], config["interviewee"], config["interviewer"], systemPromptTemplate=open(config["systemPromptTemplate"], 'r', encoding='utf-8').read())
+            return QnAModel(llm, loadConfigQnA(config), config["additionalInformation"], config["interviewee"], config["interviewer"], systemPromptTemplate=open(config["systemPromptTemplate"], 'r', encoding='utf-8').read())
+
+    # load a persona compiled with directRetrieval.artifact, its items are memory-mapped and its prompt is precompiled
+    @classmethod
+    def fromArtifact(cls, llm: LLMInterface, artifactPath: str) -> "QnAModel":
+        from .artifact import loadArtifact
+        return loadArtifact(llm, artifactPath)
 
     def getJSONAnswer(self, question: str) -> Dict:
         messages, properties = self.generateQnASelectionPrompt(question=question)
-        response = generate_response(self.llm, messages, properties, temperature=0, stream=False)
+        response, usage = self._generate(messages, properties)
         assert isinstance(response, dict), "Response is not a dictionary"
+        self._recordUsage(messages, response, usage)
         return response
 
+    # the response and the "usage" field the backend sent with it, empty when it sent none
+    def _generate(self, messages: List[Dict[str, str]], properties: Dict) -> Tuple[Union[Dict, str], Dict]:
+        with instrumentation.captureUsage() as usage:
+            response = generate_response(self.llm, messages, properties, temperature=0, stream=False)
+        return response, usage
+
+    def _recordUsage(self, messages: List[Dict[str, str]], response: Union[Dict, str], usage: Union[Dict, None] = None):
+        if usage and "prompt_tokens" in usage:
+            # counted by the backend, the interface already reported them
+            self.lastUsage["promptTokens"] = usage["prompt_tokens"]
+            self.lastUsage["completionTokens"] = usage.get("completion_tokens", 0)
+            self.lastUsage["exact"] = True
+            return
+        # the exact tokenizer can take a round trip to the server, it is only used when a budget is enforced
+        estimator = self.getTokenEstimator() if self.contextBudget is not None else _APPROXIMATE_TOKENS
+        completion = response if isinstance(response, str) else json.dumps(response)
+        self.lastUsage["promptTokens"] = estimator.countMessages(messages)
+        self.lastUsage["completionTokens"] = estimator.countTokens(completion, cache=False)
+        self.lastUsage["exact"] = estimator.exact
+        instrumentation.tokens(self.lastUsage["promptTokens"], self.lastUsage["completionTokens"], source="tokenizer" if estimator.exact else "estimate")
+
     def getQnA_ID(self, question: str) -> str:
         response = self.getJSONAnswer(question)
+        return self.responseID(response)
+
+    # Coroutine versions, for serving many questions from one event loop. Prompt building and token counting
+    # run in the default executor, sync interfaces are called there as well.
+    async def getJSONAnswerAsync(self, question: str) -> Dict:
+        # asyncio is only imported by programs using the coroutines
+        import asyncio
+        loop = asyncio.get_running_loop()
+        messages, properties = await loop.run_in_executor(None, self.generateQnASelectionPrompt, question)
+        if isinstance(self.llm, AsyncLLMInterface):
+            with instrumentation.captureUsage() as usage:
+                response = await async_generate_response(self.llm, messages, properties, temperature=0, stream=False)
+        else:
+            response, usage = await loop.run_in_executor(None, self._generate, messages, properties)
+        assert isinstance(response, dict), "Response is not a dictionary"
+        if usage or self.contextBudget is None:
+            self._recordUsage(messages, response, usage)
+        else:
+            await loop.run_in_executor(None, self._recordUsage, messages, response, usage)
+        return response
+
+    async def getQnA_IDAsync(self, question: str) -> str:
+        response = await self.getJSONAnswerAsync(question)
+        return self.responseID(response)
+
+    async def getAnswerAsync(self, question: str) -> str:
+        with instrumentation.stage("get_answer"):
+            ID = await self.getQnA_IDAsync(question)
+            if ID == "":
+                return ""
+            return self.answerByID(ID)
+
+    # the selection response text as it is generated, with an async interface streaming schema constrained output
+    async def streamJSONAnswerAsync(self, question: str) -> AsyncIterator[str]:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        messages, properties = await loop.run_in_executor(None, self.generateQnASelectionPrompt, question)
+        if not isinstance(self.llm, AsyncLLMInterface):
+            raise TypeError(f"Streaming needs an async interface, not {type(self.llm).__name__}")
+        tokens = await async_generate_response(self.llm, messages, properties, temperature=0, stream=True)
+        async for token in tokens:
+            yield token
+
+    def responseID(self, response: Dict) -> str:
         if response["Is_answer_in_QnA"]:
             qnaItem: QnA_Item = self.qna[response[self.ANSWER_KEY]["question_number"]]
             return qnaItem.ID
         else:
             return ""
+
+    # shallow copy sharing the QnA and configuration, but answering with another backend
+    def withLLM(self, llm: LLMInterface) -> "QnAModel":
+        model = QnAModel.__new__(QnAModel)
+        model.__dict__.update(self.__dict__)
+        model.llm = llm
+        model.tokenEstimator = None
+        model.lastUsage = {}
+        return model
     
     def getAnswer(self, question: str) -> str:
-        ID = self.getQnA_ID(question)
-        if ID == "":
-            return ""
-        for qnaItem in self.qna:
-            if qnaItem.ID == ID:
-                return qnaItem.answer
+        with instrumentation.stage("get_answer"):
+            ID = self.getQnA_ID(question)
+            if ID == "":
+                return ""
+            return self.answerByID(ID)
+
+    def answerByID(self, ID: str) -> str:
+        with instrumentation.stage("id_lookup"):
+            getByID = getattr(self.qna, "getByID", None)
+            if getByID is not None:
+                return getByID(ID).answer
+            for qnaItem in self.qna:
+                if qnaItem.ID == ID:
+                    return qnaItem.answer
         raise ValueError("ID not found in QnA list")
 
-    def createQnAString(self) -> str:
-        questions = self.qna
-        newQuestions: List[Dict[str,str | int]] = [
-            {
-                "tags": " ".join(question.tags),
-                "question": question.question,
-                "question_number": i,
-                "answer": question.answer,
-            }
-            for i, question in enumerate(questions)]
-        return json.dumps(newQuestions, indent=2)
+    # (question_number, item) pairs, the number is the position unless items were added or removed
+    def qnaEntries(self) -> List[Tuple[int, QnA_Item]]:
+        entries = getattr(self.qna, "entries", None)
+        return entries() if entries is not None else list(enumerate(self.qna))
+
+    # Editing switches the QnA to an EditableQnA, holding the items in memory. Question numbers of the
+    # other items do not change, and the next prompt only renders the entries of the items that changed.
+    def _editableQnA(self) -> EditableQnA:
+        if not isinstance(self.qna, EditableQnA):
+            self.qna = EditableQnA(self.qna)
+        return self.qna
+
+    def _itemsChanged(self, qna: EditableQnA, questionNumber: int, qnaItem: Union[QnA_Item, None]):
+        self._fragments.itemChanged(qna, questionNumber, qnaItem)
+        self._promptCache = {}
+        self._precompiledPrompts = {}
+
+    # returns the question number of the new item
+    def addItem(self, qnaItem: QnA_Item) -> int:
+        qna = self._editableQnA()
+        number = qna.add(qnaItem)
+        self._itemsChanged(qna, number, qnaItem)
+        return number
+
+    def updateItem(self, ID: str, qnaItem: QnA_Item) -> int:
+        qna = self._editableQnA()
+        number = qna.update(ID, qnaItem)
+        self._itemsChanged(qna, number, qnaItem)
+        return number
+
+    def removeItem(self, ID: str) -> QnA_Item:
+        qna = self._editableQnA()
+        number = qna.indexOf(ID)
+        qnaItem = qna.remove(ID)
+        self._itemsChanged(qna, number, None)
+        return qnaItem
+
+    def createQnAString(self, qnaFormat: Union[str, None] = None) -> str:
+        return renderQnA(self.qnaEntries(), qnaFormat if qnaFormat is not None else self.qnaFormat, self.answerPreviewLength)
 
     def createQnAObjectList(self) -> List[Dict]:
-        questions = self.qna
         newQuestions: List[Dict[str,str | int]] = [
             {
                 "tags": " ".join(question.tags),
@@ -109,9 +449,143 @@ class QnAModel:
                 "question_number": i,
                 "answer": question.answer,
             }
-            for i, question in enumerate(questions)]
+            for i, question in self.qnaEntries()]
         return newQuestions
 
+    def getTokenEstimator(self) -> TokenEstimator:
+        if self.tokenEstimator is None:
+            self.tokenEstimator = tokenEstimatorFor(self.llm)
+        return self.tokenEstimator
+
+    # the system message and schema only depend on the QnA and the configuration, not on the question
+    def _promptCacheKey(self, qnaFormat: str) -> Tuple:
+        return (qnaFormat, id(self.qna), len(self.qna), getattr(self.qna, "version", 0), self.answerPreviewLength, self.systemPromptTemplate, self.interviewee, self.interviewer, id(self.additionalInformation))
+
+    # must be called after editing items of self.qna in place
+    def invalidatePromptCache(self):
+        self._promptCache = {}
+        self._precompiledPrompts = {}
+        self._fragments = FragmentCache()
+
+    # system message and serialized schema rendered ahead of time for the current QnA and configuration
+    def addPrecompiledPrompt(self, qnaFormat: str, systemMessage: str, serializedProperties: Union[str, bytes, memoryview]):
+        self._precompiledPrompts[self._promptCacheKey(qnaFormat)] = (systemMessage, serializedProperties)
+
+    def selectionPrompt(self, qnaFormat: Union[str, None] = None) -> Tuple[str, Dict]:
+        qnaFormat = qnaFormat if qnaFormat is not None else self.qnaFormat
+        key = self._promptCacheKey(qnaFormat)
+        cached = self._promptCache.get(key)
+        if cached is None:
+            instrumentation.event("prompt_cache_miss", qnaFormat=qnaFormat)
+            precompiled = self._precompiledPrompts.get(key)
+            if precompiled is not None:
+                systemMessage, serializedProperties = precompiled
+                cached = (systemMessage, json.loads(bytes(serializedProperties) if isinstance(serializedProperties, memoryview) else serializedProperties))
+            else:
+                cached = self.buildSelectionPrompt(self.qnaEntries(), qnaFormat, complete=True)
+            self._promptCache[key] = cached
+        else:
+            instrumentation.event("prompt_cache_hit", qnaFormat=qnaFormat)
+        return cached
+
+    # create the system message and properties for a subset of the QnA, given as (question_number, item) pairs
+    # complete=True when the entries are the whole QnA
+    def buildSelectionPrompt(self, entries: List[Tuple[int, QnA_Item]], qnaFormat: str, complete: bool = False) -> Tuple[str, Dict]:
+        information = self.additionalInformation
+        interviewee = self.interviewee
+        interviewer = self.interviewer
+
+        with instrumentation.stage("qna_render", items=len(entries), qnaFormat=qnaFormat) as renderStage:
+            # entries rendered for an earlier prompt are reused
+            hits = self._fragments.hits
+            if complete and isinstance(self.qna, EditableQnA):
+                fragments, qnaChoices = self._fragments.buildEditable(self.qna, qnaFormat, self.answerPreviewLength)
+            else:
+                # the whole prompt of a read-only QnA is kept joined in _promptCache, not a second time as entries
+                fragments, qnaChoices = self._fragments.build(entries, qnaFormat, self.answerPreviewLength, complete, keep=not complete)
+            qnaString = joinQnA(fragments, qnaFormat)
+            renderStage.set("reused", self._fragments.hits - hits)
+
+        with instrumentation.stage("schema_build", items=len(entries)):
+            outputs = {
+                "Requested_Information":
+                    {"type": "string",
+                    "explanation": f"The context of the question and what information the question is aiming to obtain from {interviewee} exactly.",
+                    },
+                "Eventual_answer":
+                    {"type": "string",
+                    "explanation": f"Based on the QnA, what do you think {interviewee} would answer to the given question?",
+                    },
+                self.ANSWER_KEY: {
+                    "type": "object",
+                    "anyOf": qnaChoices,
+                    "explanation": "Based on the extracted 'Requested_Information', return the verbatim question and answer from the QnA that provides the requested information by the given question, as an object with the fields \"tags\", \"question\", \"question_number\" and \"answer\". Each field MUST be an exact copy of the question and answer from the QnA, not a paraphrase.",
+                },
+                "Is_answer_in_QnA":
+                    {"type": "boolean",
+                    "explanation": "Whether the question was answered in the QnA or not (for example if the selected question and answer pair provides the information to answer the given question).",},
+            }
+
+
+            # extract the explanation of the outputs
+            json_explanation = "\n".join([f"{key}: {outputs[key]['explanation']}" for key in outputs])
+            # remove the explanation from the outputs
+            for key in outputs:
+                del outputs[key]["explanation"]
+            properties = outputs
+        
+        info = ""
+        for key in information:
+            info += f"{key}: {information[key]}\n"
+        # accept systemPromptTemplate as jinja2 template, in that case use Template.render
+        with instrumentation.stage("jinja_render"):
+            # jinja2 is only imported once a prompt is rendered, importing directRetrieval stays cheap
+            import jinja2
+            systemMessage = jinja2.Template(self.systemPromptTemplate).render(json_explanation=json_explanation, additionalInformation=info, qna=qnaString, interviewee=interviewee, interviewer=interviewer)
+        return systemMessage, properties
+
+    def _selectionMessages(self, systemMessage: str, prompt: str) -> List[Dict[str, str]]:
+        return [
+                {
+                    "role": "user",
+                    "content": systemMessage,
+                },
+                {
+                    "role": "assistant",
+                    "content": "Understood, what's the question?",
+                },
+                {"role": "user", "content": prompt},
+            ]
+
+    # pick the richest rendering that fits in contextBudget, falling back to a prefiltered subset of the QnA
+    def _budgetedSelectionPrompt(self, question: str, prompt: str) -> Tuple[str, Dict, str, int]:
+        if self.contextBudget is None:
+            systemMessage, properties = self.selectionPrompt()
+            return systemMessage, properties, self.qnaFormat, len(self.qna)
+
+        estimator = self.getTokenEstimator()
+        fixedTokens = estimator.countMessages(self._selectionMessages("", prompt))
+        if self.qnaFormat in BUDGET_FALLBACK_FORMATS:
+            formats = BUDGET_FALLBACK_FORMATS[BUDGET_FALLBACK_FORMATS.index(self.qnaFormat):]
+        else:
+            formats = [self.qnaFormat] + BUDGET_FALLBACK_FORMATS
+        for qnaFormat in formats:
+            systemMessage, properties = self.selectionPrompt(qnaFormat)
+            systemTokens = estimator.countTokens(systemMessage)
+            if systemTokens + fixedTokens <= self.contextBudget:
+                return systemMessage, properties, qnaFormat, len(self.qna)
+
+        # even the cheapest rendering is too large, keep the items sharing most words with the question
+        ranked = sorted(self.qnaEntries(), key=lambda entry: overlapScore(question, entry[1]), reverse=True)
+        keep = min(len(ranked) - 1, len(ranked) * (self.contextBudget - fixedTokens) // systemTokens)
+        while keep > 0:
+            entries = sorted(ranked[:keep], key=lambda entry: entry[0])
+            systemMessage, properties = self.buildSelectionPrompt(entries, qnaFormat)
+            if estimator.countTokens(systemMessage, cache=False) + fixedTokens <= self.contextBudget:
+                return systemMessage, properties, qnaFormat, keep
+            keep = keep * 4 // 5
+        raise ValueError(f"Context budget of {self.contextBudget} tokens is too small for the system prompt")
+
     # create messages and properties from question, QnA and information
     def generateQnASelectionPrompt(
             self,
@@ -124,84 +598,28 @@ class QnAModel:
             ):
         
         qnaList = self.qna
-        information = self.additionalInformation
         systemPromptTemplate = self.systemPromptTemplate
         interviewee = self.interviewee
         interviewer = self.interviewer
         # check if the inputs are valid
         assert question != "", "Question must be provided and not empty"
-        assert qnaList != [], "QnA list must be provided and not empty"
+        assert len(qnaList) > 0, "QnA list must be provided and not empty"
         assert systemPromptTemplate != "", "System prompt template must be provided and not empty"
         assert interviewee != "", "Interviewee must be provided and not empty"
         assert interviewer != "", "Interviewer must be provided and not empty"
 
-        qnaString = self.createQnAString()
-        dictQNA = self.createQnAObjectList()
-
-        qnaEnums = dictQNA.copy()
-        qnaEnums = []
-        for qna in dictQNA:
-            tags = qna["tags"].split(" ")
-            # iterate over all possible orders of the tags
-            for perm in itertools.permutations(tags):
-                qnaEnums.append({
-                    "tags": " ".join(perm),
-                    "question": qna["question"],
-                    "question_number": qna["question_number"],
-                })
-        # print(qnaEnums)
-
-        outputs = {
-            "Requested_Information":
-                {"type": "string",
-                "explanation": f"The context of the question and what information the question is aiming to obtain from {interviewee} exactly.",
-                },
-            "Eventual_answer":
-                {"type": "string",
-                "explanation": f"Based on the QnA, what do you think {interviewee} would answer to the given question?",
-                },
-            self.ANSWER_KEY: {
-                "type": "object",
-                "anyOf": [{"const": qnaEnum} for qnaEnum in qnaEnums],
-                "explanation": "Based on the extracted 'Requested_Information', return the verbatim question and answer from the QnA that provides the requested information by the given question, as an object with the fields \"tags\", \"question\", \"question_number\" and \"answer\". Each field MUST be an exact copy of the question and answer from the QnA, not a paraphrase.",
-            },
-            "Is_answer_in_QnA":
-                {"type": "boolean",
-                "explanation": "Whether the question was answered in the QnA or not (for example if the selected question and answer pair provides the information to answer the given question).",},
-        }
-
-
-        # extract the explanation of the outputs
-        json_explanation = "\n".join([f"{key}: {outputs[key]['explanation']}" for key in outputs])
-        # remove the explanation from the outputs
-        for key in outputs:
-            del outputs[key]["explanation"]
-        properties = outputs
-        
-        info = ""
-        for key in information:
-            info += f"{key}: {information[key]}\n"
         prompt = f"{interviewer.capitalize()} Question: ```{question}```"
-        # systemMessage = systemPromptTemplate.format(json_explanation=json_explanation, info=info, qna=qnaString, interviewee=interviewee, interviewer=interviewer)
-        # accept systemPromptTemplate as jinja2 template, in that case use Template.render
-        systemMessage = jinja2.Template(systemPromptTemplate).render(json_explanation=json_explanation, additionalInformation=info, qna=qnaString, interviewee=interviewee, interviewer=interviewer)
-
+        with instrumentation.stage("prompt_build") as promptStage:
+            systemMessage, properties, rendering, items = self._budgetedSelectionPrompt(question, prompt)
+            promptStage.set("rendering", rendering)
+        self.lastUsage = {"rendering": rendering, "items": items}
 
-        messages=[
-                {
-                    "role": "user",
-                    "content": systemMessage,
-                },
-                {
-                    "role": "assistant",
-                    "content": "Understood, what's the question?",
-                },
-                {"role": "user", "content": prompt},
-            ]
+        messages = self._selectionMessages(systemMessage, prompt)
         # save messages to a file
-        with open("messages.txt", "w", encoding='utf-8') as f:
-            for message in messages:
-                f.write(message["content"] + "\n")
+        if self.messagesPath is not None:
+            with open(self.messagesPath, "w", encoding='utf-8') as f:
+                for message in messages:
+                    f.write(message["content"] + "\n")
         return messages, properties
 
     def simplePrompt(self, question: str):
@@ -224,9 +642,10 @@ List of Questions (QnA):
                 {"role": "user", "content": question},
             ]
         # save messages to a file
-        with open("messages.txt", "w", encoding='utf-8') as f:
-            for message in messages:
-                f.write(message["content"] + "\n")
+        if self.messagesPath is not None:
+            with open(self.messagesPath, "w", encoding='utf-8') as f:
+                for message in messages:
+                    f.write(message["content"] + "\n")
         return messages
     
     def simpleAnswer(self, question: str):
@@ -275,9 +694,30 @@ List of Questions (QnA):
             results.append((question, ID, targetID))
             print(f"Correct: {correct}/{total}")
         return results
+
+    # run evaluate once per rendering to compare prompt size, accuracy and latency
+    def evaluateFormats(self, q_a_pairs: List[tuple[str, str]], formats: List[str] = QNA_FORMATS) -> List[Dict]:
+        report = []
+        for qnaFormat in formats:
+            model = self.withLLM(self.llm)
+            model.qnaFormat = qnaFormat
+            systemMessage, properties = model.selectionPrompt()
+            start = time.perf_counter()
+            results = model.evaluate(q_a_pairs)
+            seconds = time.perf_counter() - start
+            correct = sum(1 for _, ID, targetID in results if ID == targetID)
+            report.append({
+                "format": qnaFormat,
+                "systemPromptTokens": model.getTokenEstimator().countTokens(systemMessage),
+                "accuracy": correct / len(results) if results else 0.0,
+                "averageLatency": seconds / len(results) if results else 0.0,
+            })
+            print(report[-1])
+        return report
         
 if __name__ == "__main__":
     import os
+    from .LLMInterfaces import LlamaCPPServer, AsyncLlamaCPPServer, OpenAISync
     llm_ = LlamaCPPServer("http://localhost:8080/v1/chat/completions")
     # llm_ = AsyncLlamaCPPServer("http://localhost:8080/v1/chat/completions")
     # llm_ = OpenAISync(os.environ["OPENAI_API_KEY"])
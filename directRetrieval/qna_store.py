@@ -0,0 +1,151 @@
+import sys
+from array import array
+from typing import List, Dict, Iterable, Iterator, Union, Sequence
+from .load_qna import QnA_Item, iter_qna_OOP
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+def _littleEndian(values: array) -> bytes:
+    if _LITTLE_ENDIAN:
+        return values.tobytes()
+    swapped = array(values.typecode, values)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+# integers stored little endian, viewed in place when the machine is little endian as well
+def _nativeArray(typecode: str, buffer):
+    if _LITTLE_ENDIAN:
+        return memoryview(buffer).cast("B").cast(typecode)
+    values = array(typecode)
+    values.frombytes(bytes(buffer))
+    values.byteswap()
+    return values
+
+class _PackedStrings:
+    # all the strings of a column as one utf-8 buffer plus offsets, instead of one str object per item
+    def __init__(self, strings: Iterable[str]):
+        parts = []
+        self.offsets = array("Q", [0])
+        for string in strings:
+            encoded = string.encode("utf-8")
+            parts.append(encoded)
+            self.offsets.append(self.offsets[-1] + len(encoded))
+        self.data = b"".join(parts)
+
+    # wrap existing buffers, e.g. memoryviews over a memory-mapped artifact, without copying them
+    @classmethod
+    def fromBuffers(cls, data, offsets) -> "_PackedStrings":
+        packed = cls.__new__(cls)
+        packed.data = data
+        packed.offsets = offsets
+        return packed
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def nbytes(self) -> int:
+        return len(self.data) + 8 * len(self.offsets)
+
+# read-only columnar storage of a persona's QnA: questions, answers and IDs in packed buffers and
+# tags as indices into a table of interned strings. Indexing returns QnA_Item objects built on demand,
+# so it can be used wherever a List[QnA_Item] is expected.
+class QnAStore(Sequence[QnA_Item]):
+    tagTable: List[str]
+
+    def __init__(self, items: Iterable[QnA_Item]):
+        IDs: List[str] = []
+        questions: List[str] = []
+        answers: List[str] = []
+        self.tagTable = []
+        tagNumbers: Dict[str, int] = {}
+        self._tags = array("I")
+        self._tagOffsets = array("I", [0])
+        for qnaItem in items:
+            IDs.append(qnaItem.ID)
+            questions.append(qnaItem.question)
+            answers.append(qnaItem.answer)
+            for tag in qnaItem.tags:
+                number = tagNumbers.get(tag)
+                if number is None:
+                    number = tagNumbers[tag] = len(self.tagTable)
+                    self.tagTable.append(sys.intern(tag))
+                self._tags.append(number)
+            self._tagOffsets.append(len(self._tags))
+        self._IDs = _PackedStrings(IDs)
+        self._questions = _PackedStrings(questions)
+        self._answers = _PackedStrings(answers)
+        self._count = len(IDs)
+        self._IDIndex: Union[Dict[str, int], None] = None
+
+    @classmethod
+    def fromFile(cls, filename: str) -> "QnAStore":
+        return cls(iter_qna_OOP(filename))
+
+    # the raw columns, as written to and read back from a compiled persona artifact
+    def buffers(self) -> Dict[str, bytes]:
+        return {
+            "ids": bytes(self._IDs.data),
+            "idOffsets": _littleEndian(self._IDs.offsets),
+            "questions": bytes(self._questions.data),
+            "questionOffsets": _littleEndian(self._questions.offsets),
+            "answers": bytes(self._answers.data),
+            "answerOffsets": _littleEndian(self._answers.offsets),
+            "tagTable": "\n".join(self.tagTable).encode("utf-8"),
+            "tags": _littleEndian(self._tags),
+            "tagOffsets": _littleEndian(self._tagOffsets),
+        }
+
+    @classmethod
+    def fromBuffers(cls, buffers: Dict) -> "QnAStore":
+        store = cls.__new__(cls)
+        tagTable = str(buffers["tagTable"], "utf-8")
+        store.tagTable = [sys.intern(tag) for tag in tagTable.split("\n")] if tagTable else []
+        store._tags = _nativeArray("I", buffers["tags"])
+        store._tagOffsets = _nativeArray("I", buffers["tagOffsets"])
+        store._IDs = _PackedStrings.fromBuffers(buffers["ids"], _nativeArray("Q", buffers["idOffsets"]))
+        store._questions = _PackedStrings.fromBuffers(buffers["questions"], _nativeArray("Q", buffers["questionOffsets"]))
+        store._answers = _PackedStrings.fromBuffers(buffers["answers"], _nativeArray("Q", buffers["answerOffsets"]))
+        store._count = len(store._tagOffsets) - 1
+        store._IDIndex = None
+        return store
+
+    def __len__(self) -> int:
+        return self._count
+
+    def ID(self, i: int) -> str:
+        return self._IDs[i]
+
+    def question(self, i: int) -> str:
+        return self._questions[i]
+
+    def answer(self, i: int) -> str:
+        return self._answers[i]
+
+    def tags(self, i: int) -> List[str]:
+        return [self.tagTable[number] for number in self._tags[self._tagOffsets[i]:self._tagOffsets[i + 1]]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("QnA index out of range")
+        return QnA_Item(self._IDs[i], self.tags(i), self._questions[i], self._answers[i])
+
+    def __iter__(self) -> Iterator[QnA_Item]:
+        for i in range(self._count):
+            yield self[i]
+
+    def indexOf(self, ID: str) -> int:
+        if self._IDIndex is None:
+            self._IDIndex = {self._IDs[i]: i for i in range(self._count)}
+        return self._IDIndex[ID]
+
+    def getByID(self, ID: str) -> QnA_Item:
+        return self[self.indexOf(ID)]
+
+    def nbytes(self) -> int:
+        return (self._IDs.nbytes() + self._questions.nbytes() + self._answers.nbytes()
+                + 4 * len(self._tags) + 4 * len(self._tagOffsets)
+                + sum(sys.getsizeof(tag) for tag in self.tagTable))
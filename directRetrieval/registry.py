@@ -0,0 +1,169 @@
+from typing import List, Dict, Union
+import os
+import time
+import threading
+from collections import OrderedDict
+from .qna import QnAModel
+from .artifact import loadOrCompile
+from .reload import PersonaWatcher
+from .LLMInterfaces import LLMInterface
+
+# Serves many personas from a directory of configs (<name>.config or <name>.json) with one shared interface.
+# At most `capacity` personas stay loaded, with their prompt and schema already built; the least recently used
+# one is evicted beyond that. With promptCacheSlots > 0 and an interface supporting withOptions (llama.cpp server),
+# every resident persona also gets its own server slot so its prompt prefix stays in the server's KV cache.
+# Pinning sends all the requests of a persona to that one slot, which answers one request at a time: concurrent
+# questions to the same persona wait for each other instead of using the server's other slots, so it suits many
+# personas with a few requests each, not one busy persona.
+# With a reloadInterval, the source files of resident personas are polled and changed personas reloaded in place.
+class QnAModelRegistry:
+    llm: LLMInterface
+    configDirectory: str
+    capacity: int
+    useArtifacts: bool
+    promptCacheSlots: int
+    reloadInterval: Union[float, None]
+    CONFIG_EXTENSIONS = (".config", ".json")
+
+    def __init__(self, llm: LLMInterface, configDirectory: str, capacity: int = 32, useArtifacts: bool = False, promptCacheSlots: int = 0, reloadInterval: Union[float, None] = None):
+        assert capacity > 0, "Capacity must be at least 1"
+        self.llm = llm
+        self.configDirectory = configDirectory
+        self.capacity = capacity
+        self.useArtifacts = useArtifacts
+        self.promptCacheSlots = promptCacheSlots
+        self.reloadInterval = reloadInterval
+        # a watched persona is held only through its watcher, so a reload leaves the old version unreferenced
+        self._models: "OrderedDict[str, Union[QnAModel, PersonaWatcher]]" = OrderedDict()
+        self._slots: Dict[str, int] = {}
+        self._freeSlots = list(range(promptCacheSlots - 1, -1, -1))
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.loadSeconds = 0.0
+
+    def configPath(self, name: str) -> str:
+        # persona names come from requests, a name is a file of the config directory and never a path
+        if not name or name.startswith(".") or os.sep in name or (os.altsep is not None and os.altsep in name):
+            raise KeyError(f"Invalid persona name {name!r}")
+        for extension in self.CONFIG_EXTENSIONS:
+            path = os.path.join(self.configDirectory, name + extension)
+            if os.path.exists(path):
+                return path
+        raise KeyError(f"No config for persona {name!r} in {self.configDirectory}")
+
+    def names(self) -> List[str]:
+        return sorted(
+            os.path.splitext(filename)[0]
+            for filename in os.listdir(self.configDirectory)
+            if filename.endswith(self.CONFIG_EXTENSIONS))
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self.configPath(name)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, name: str) -> QnAModel:
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                self.hits += 1
+                return entry.poll() if isinstance(entry, PersonaWatcher) else entry
+            self.misses += 1
+            loading = self._loading.setdefault(name, threading.Lock())
+        # load outside of the registry lock, concurrent requests for the same persona wait for a single load
+        with loading:
+            with self._lock:
+                entry = self._models.get(name)
+                if entry is not None:
+                    self._models.move_to_end(name)
+                    return entry.model if isinstance(entry, PersonaWatcher) else entry
+            start = time.perf_counter()
+            entry = self._load(name)
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.loads += 1
+                self.loadSeconds += seconds
+                self._models[name] = entry
+                while len(self._models) > self.capacity:
+                    self._evictOldest()
+                self._loading.pop(name, None)
+            return entry.model if isinstance(entry, PersonaWatcher) else entry
+
+    def _load(self, name: str) -> Union[QnAModel, PersonaWatcher]:
+        configPath = self.configPath(name)
+        llm = self.llm
+        slot = None
+        with self._lock:
+            if self._freeSlots and hasattr(llm, "withOptions"):
+                slot = self._freeSlots.pop()
+        if slot is not None:
+            llm = llm.withOptions({"id_slot": slot, "cache_prompt": True})
+        try:
+            if self.useArtifacts:
+                model = loadOrCompile(llm, configPath)
+            else:
+                model = QnAModel.fromConfigFile(llm, configPath)
+            model.configPath = configPath
+            # build the prompt and schema now rather than on the first question
+            model.selectionPrompt()
+        except Exception:
+            if slot is not None:
+                with self._lock:
+                    self._freeSlots.append(slot)
+            raise
+        if slot is not None:
+            with self._lock:
+                self._slots[name] = slot
+        if self.reloadInterval is not None:
+            return PersonaWatcher(model, configPath, self.reloadInterval)
+        return model
+
+    def _release(self, name: str):
+        slot = self._slots.pop(name, None)
+        if slot is not None:
+            self._freeSlots.append(slot)
+
+    def _evictOldest(self):
+        name, _ = self._models.popitem(last=False)
+        self.evictions += 1
+        self._release(name)
+
+    def evict(self, name: str):
+        with self._lock:
+            if self._models.pop(name, None) is not None:
+                self.evictions += 1
+                self._release(name)
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._models):
+                self._models.pop(name)
+                self._release(name)
+
+    def resident(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "capacity": self.capacity,
+                "resident": len(self._models),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                "loadSeconds": self.loadSeconds,
+                "averageLoadSeconds": self.loadSeconds / self.loads if self.loads else 0.0,
+                "promptCacheSlots": dict(self._slots),
+                "reloads": sum(entry.reloads for entry in self._models.values() if isinstance(entry, PersonaWatcher)),
+            }
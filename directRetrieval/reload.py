@@ -0,0 +1,147 @@
+from typing import List, Dict, Tuple, Union
+import os
+import json
+import time
+import threading
+from .qna import QnAModel, loadConfigQnA, DEFAULT_SYSTEM_PROMPT_TEMPLATE
+from . import instrumentation
+
+# (modification time, size) of a file, None when it does not exist
+def fileSignature(path: str) -> Union[Tuple[int, int], None]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def readConfig(configPath: str) -> Dict:
+    with open(configPath, "r", encoding='utf-8') as f:
+        return json.load(f)
+
+def watchedFiles(configPath: str, config: Dict) -> Dict[str, str]:
+    files = {"config": configPath, "qna": config["qna"]}
+    if "systemPromptTemplate" in config:
+        files["systemPromptTemplate"] = config["systemPromptTemplate"]
+    return files
+
+# new version of a model after some of its source files changed. Unchanged parts are shared with the old
+# version: the QnA is only parsed again when it changed, the prompt cache is kept when the QnA and the
+# information did not change, and otherwise prompts are rebuilt from the cached rendered entries of unchanged items.
+def reloadModel(model: QnAModel, config: Dict, previousConfig: Dict, changed: List[str]) -> QnAModel:
+    reloaded = QnAModel.__new__(QnAModel)
+    reloaded.__dict__.update(model.__dict__)
+    reloaded.tokenEstimator = None
+    reloaded.lastUsage = {}
+
+    if "qna" in changed or any(config.get(key) != previousConfig.get(key) for key in ("qna", "lazyLoad", "columnar")):
+        reloaded.qna = loadConfigQnA(config)
+    if "systemPromptTemplate" not in config:
+        reloaded.systemPromptTemplate = DEFAULT_SYSTEM_PROMPT_TEMPLATE
+    elif "systemPromptTemplate" in changed or config["systemPromptTemplate"] != previousConfig.get("systemPromptTemplate"):
+        with open(config["systemPromptTemplate"], 'r', encoding='utf-8') as f:
+            reloaded.systemPromptTemplate = f.read()
+    # keep the same object when the information did not change, the prompt cache key depends on it
+    if config["additionalInformation"] != model.additionalInformation:
+        reloaded.additionalInformation = config["additionalInformation"]
+    reloaded.interviewee = config["interviewee"]
+    reloaded.interviewer = config["interviewer"]
+
+    if reloaded.qna is model.qna and reloaded.additionalInformation is model.additionalInformation:
+        reloaded._promptCache = dict(model._promptCache)
+        reloaded._precompiledPrompts = dict(model._precompiledPrompts)
+    else:
+        reloaded._promptCache = {}
+        reloaded._precompiledPrompts = {}
+    reloaded._fragments = model._fragments.copy()
+    return reloaded
+
+# Polls the config, QnA and template files of a persona and swaps in a reloaded model when one of them changed.
+# The new version is built and its prompts warmed next to the old one, then `model` is replaced by a single
+# assignment: callers read `watcher.model` once per request, so requests in flight finish on the old version.
+class PersonaWatcher:
+    model: QnAModel
+    configPath: str
+    interval: float
+    reloads: int
+    lastReloadSeconds: float
+    lastError: Union[Exception, None]
+
+    def __init__(self, model: QnAModel, configPath: Union[str, None] = None, interval: float = 1.0):
+        self.configPath = configPath if configPath is not None else model.configPath
+        assert self.configPath, "The model was not loaded from a config file, a configPath must be given"
+        self.interval = interval
+        self.reloads = 0
+        self.lastReloadSeconds = 0.0
+        self.lastError = None
+        self._lock = threading.Lock()
+        self._lastCheck = time.monotonic()
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+        self._config = readConfig(self.configPath)
+        self._files = watchedFiles(self.configPath, self._config)
+        self._signatures = {name: fileSignature(path) for name, path in self._files.items()}
+        self.model = model
+
+    def changedFiles(self) -> List[str]:
+        return [name for name, path in self._files.items() if fileSignature(path) != self._signatures[name]]
+
+    # reload now if a file changed, returns whether a new version was swapped in
+    def check(self) -> bool:
+        with self._lock:
+            self._lastCheck = time.monotonic()
+            changed = self.changedFiles()
+            if not changed:
+                return False
+            start = time.perf_counter()
+            try:
+                config = readConfig(self.configPath)
+                files = watchedFiles(self.configPath, config)
+                # signatures are taken before reading, a write during the reload is picked up by the next check
+                signatures = {name: fileSignature(path) for name, path in files.items()}
+                with instrumentation.stage("reload", changed=",".join(changed)):
+                    reloaded = reloadModel(self.model, config, self._config, changed)
+                    reloaded.configPath = self.configPath
+                    # warm the prompt before the swap, the first request on the new version does not pay for it
+                    reloaded.selectionPrompt()
+            except Exception as exception:
+                # a half written file, keep serving the old version and try again on the next check
+                self.lastError = exception
+                instrumentation.event("reload_failed", error=type(exception).__name__)
+                return False
+            self._config = config
+            self._files = files
+            self._signatures = signatures
+            self.lastError = None
+            self.reloads += 1
+            self.lastReloadSeconds = time.perf_counter() - start
+            self.model = reloaded
+            return True
+
+    # cheap enough to call on every request: checks at most once per interval, and reloads in the background
+    # so the request is answered by the current version right away
+    def poll(self) -> QnAModel:
+        if time.monotonic() - self._lastCheck >= self.interval and not self._lock.locked():
+            self._lastCheck = time.monotonic()
+            threading.Thread(target=self.check, daemon=True).start()
+        return self.model
+
+    def start(self) -> "PersonaWatcher":
+        def watch():
+            while not self._stop.wait(self.interval):
+                self.check()
+        self._stop.clear()
+        self._thread = threading.Thread(target=watch, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "PersonaWatcher":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,409 @@
+from typing import List, Dict, Tuple, Union, Callable, Awaitable, AsyncIterator
+import json
+import signal
+import asyncio
+from urllib.parse import urlsplit
+from .qna import QnAModel
+from .registry import QnAModelRegistry
+from .instrumentation import PrometheusExporter
+from . import instrumentation
+from .LLMInterfaces import LLMInterface, AsyncLLMInterface
+
+# HTTP API over the personas of a QnAModelRegistry, on a single asyncio event loop:
+#   POST /answer  {"persona", "question"}     -> {"persona", "question", "id", "answer"}
+#   POST /id      {"persona", "question"}     -> {"persona", "question", "id"}
+#   POST /batch   {"persona", "questions"}    -> {"persona", "results": [{"question", "id", "answer"} or {"question", "error"}]}
+#   POST /stream  {"persona", "question"}     -> server-sent events: "token" while the selection is generated, then "answer"
+#   GET  /health, /metrics (Prometheus), /personas
+# Questions wait in one bounded queue served by `workers` concurrent workers. A full queue answers 503 with
+# Retry-After right away instead of queueing without bound, so load balancers and clients can back off.
+
+MAX_BODY_BYTES = 1 << 20
+
+class _HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Union[Dict[str, str], None] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers if headers is not None else {}
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+# dispatches every call to the replica with the fewest calls in flight
+class ReplicaSet(AsyncLLMInterface):
+    interfaces: List[AsyncLLMInterface]
+
+    def __init__(self, interfaces: List[AsyncLLMInterface]):
+        assert len(interfaces) > 0, "At least one interface is needed"
+        self.interfaces = interfaces
+        self._inFlight = [0] * len(interfaces)
+
+    # same replicas with extra request options, e.g. a llama.cpp prompt cache slot, sharing the in flight counts
+    def withOptions(self, options: Dict) -> "ReplicaSet":
+        replicas = ReplicaSet([interface.withOptions(options) for interface in self.interfaces])
+        replicas._inFlight = self._inFlight
+        return replicas
+
+    async def getResponse(self, messages: List[Dict[str, str]], properties: Union[Dict, None], temperature: int = 0, stream: bool = False):
+        i = min(range(len(self.interfaces)), key=self._inFlight.__getitem__)
+        self._inFlight[i] += 1
+        try:
+            response = await self.interfaces[i].getResponse(messages, properties, temperature, stream)
+        except BaseException:
+            self._inFlight[i] -= 1
+            raise
+        if not stream:
+            self._inFlight[i] -= 1
+            return response
+        return self._release(i, response)
+
+    async def aclose(self):
+        for interface in self.interfaces:
+            aclose = getattr(interface, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def _release(self, i: int, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        try:
+            async for token in tokens:
+                yield token
+        finally:
+            self._inFlight[i] -= 1
+
+class QnAServer:
+    registry: QnAModelRegistry
+    workers: int
+    queueSize: int
+    maxBatch: int
+    shutdownTimeout: float
+    exporter: PrometheusExporter
+
+    def __init__(self, registry: QnAModelRegistry, workers: int = 32, queueSize: int = 1024, maxBatch: int = 256, shutdownTimeout: float = 30.0):
+        self.registry = registry
+        self.workers = workers
+        self.queueSize = queueSize
+        # a batch larger than the queue could never be accepted, it is refused with 413 instead of 503 and Retry-After
+        self.maxBatch = min(maxBatch, queueSize)
+        self.shutdownTimeout = shutdownTimeout
+        self.exporter = PrometheusExporter()
+        self.draining = False
+        self.active = 0
+        self.rejected = 0
+        self.responses: Dict[Tuple[str, int], int] = {}
+        self._queue: "Union[asyncio.Queue[Tuple[Callable[[], Awaitable], asyncio.Future]], None]" = None
+        self._workerTasks: List[asyncio.Task] = []
+        self._server: Union[asyncio.AbstractServer, None] = None
+        # writer -> whether a request is being handled on that connection
+        self._connections: Dict[asyncio.StreamWriter, bool] = {}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        instrumentation.addHook(self.exporter)
+        self._queue = asyncio.Queue(self.queueSize)
+        self._workerTasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._handleConnection, host, port)
+
+    @property
+    def port(self) -> int:
+        assert self._server is not None, "Server not started"
+        return self._server.sockets[0].getsockname()[1]
+
+    # stop accepting, let queued and running questions finish (up to shutdownTimeout), then stop the workers
+    async def shutdown(self):
+        self.draining = True
+        if self._server is not None:
+            self._server.close()
+        for writer, busy in list(self._connections.items()):
+            if not busy:
+                writer.close()
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), self.shutdownTimeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._workerTasks:
+            task.cancel()
+        await asyncio.gather(*self._workerTasks, return_exceptions=True)
+        self._workerTasks = []
+        aclose = getattr(self.registry.llm, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        instrumentation.removeHook(self.exporter)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        await self.start(host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signalNumber in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signalNumber, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        print(f"Serving {len(self.registry.names())} personas on http://{host}:{self.port} with {self.workers} workers")
+        try:
+            await stop.wait()
+        finally:
+            await self.shutdown()
+
+    async def _worker(self):
+        assert self._queue is not None
+        while True:
+            job, future = await self._queue.get()
+            try:
+                # the client may have gone away while the question was queued
+                if not future.done():
+                    self.active += 1
+                    try:
+                        result = await job()
+                        if not future.done():
+                            future.set_result(result)
+                    except Exception as exception:
+                        if not future.done():
+                            future.set_exception(exception)
+                    finally:
+                        self.active -= 1
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, job: Callable[[], Awaitable]) -> asyncio.Future:
+        assert self._queue is not None
+        if self.draining:
+            raise _HTTPError(503, "Shutting down")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise _HTTPError(503, "Too many queued questions", {"Retry-After": "1"})
+        return future
+
+    async def _model(self, persona: str) -> QnAModel:
+        if not isinstance(persona, str) or persona not in self.registry:
+            raise _HTTPError(404, f"Unknown persona {persona!r}")
+        # loading a persona reads and renders its QnA, keep that off the event loop
+        model = await asyncio.get_running_loop().run_in_executor(None, self.registry.get, persona)
+        model.messagesPath = None
+        return model
+
+    async def _answer(self, persona: str, question: str, withAnswer: bool = True) -> Dict:
+        model = await self._model(persona)
+        response = await model.getJSONAnswerAsync(question)
+        result = {"persona": persona, "question": question, "id": model.responseID(response)}
+        if withAnswer:
+            result["answer"] = model.answerByID(result["id"]) if result["id"] != "" else ""
+        return result
+
+    async def _streamAnswer(self, persona: str, question: str, events: "asyncio.Queue[Tuple[str, object]]", stopped: asyncio.Event):
+        try:
+            model = await self._model(persona)
+            if isinstance(model.llm, AsyncLLMInterface):
+                parts = []
+                async for token in model.streamJSONAnswerAsync(question):
+                    if stopped.is_set():
+                        return
+                    parts.append(token)
+                    events.put_nowait(("token", token))
+                response = json.loads("".join(parts))
+            else:
+                response = await model.getJSONAnswerAsync(question)
+            ID = model.responseID(response)
+            events.put_nowait(("answer", {"persona": persona, "question": question, "id": ID, "answer": model.answerByID(ID) if ID != "" else ""}))
+        except _HTTPError as exception:
+            events.put_nowait(("error", {"error": str(exception)}))
+        except Exception as exception:
+            events.put_nowait(("error", {"error": f"{type(exception).__name__}: {exception}"}))
+        finally:
+            events.put_nowait(("end", None))
+
+    def _question(self, request: Dict, key: str = "question") -> str:
+        question = request.get(key)
+        if not isinstance(question, str) or question.strip() == "":
+            raise _HTTPError(400, f"'{key}' must be a non empty string")
+        return question
+
+    async def _handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections[writer] = False
+        try:
+            while not self.draining:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                self._connections[writer] = True
+                method, target, version = requestLine.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, "", 413, {"error": "Request body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                keepAlive = await self._dispatch(method, urlsplit(target).path, body, writer, keepAlive)
+                self._connections[writer] = False
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    # returns whether the connection can be kept open
+    async def _dispatch(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter, keepAlive: bool) -> bool:
+        endpoint = path.rstrip("/") or "/"
+        try:
+            if method == "GET":
+                if endpoint in ("/health", "/healthz"):
+                    health = {"status": "draining" if self.draining else "ok", "queued": self._queue.qsize() if self._queue is not None else 0, "active": self.active, "workers": self.workers, "resident": len(self.registry.resident())}
+                    await self._respond(writer, endpoint, 503 if self.draining else 200, health, keepAlive)
+                elif endpoint == "/metrics":
+                    await self._respondRaw(writer, endpoint, 200, self.metrics().encode("utf-8"), "text/plain; version=0.0.4", keepAlive)
+                elif endpoint == "/personas":
+                    await self._respond(writer, endpoint, 200, {"personas": self.registry.names(), "resident": self.registry.resident()}, keepAlive)
+                else:
+                    raise _HTTPError(404, f"No endpoint {path}")
+                return keepAlive
+            if method != "POST":
+                raise _HTTPError(405, f"Method {method} not allowed")
+            try:
+                request = json.loads(body or b"{}")
+                assert isinstance(request, dict)
+            except (ValueError, AssertionError):
+                raise _HTTPError(400, "The body must be a JSON object")
+            persona = request.get("persona")
+
+            if endpoint in ("/answer", "/id"):
+                question = self._question(request)
+                result = await self._submit(lambda: self._answer(persona, question, withAnswer=endpoint == "/answer"))
+                await self._respond(writer, endpoint, 200, result, keepAlive)
+            elif endpoint == "/batch":
+                questions = request.get("questions")
+                if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+                    raise _HTTPError(400, "'questions' must be a list of strings")
+                if len(questions) > self.maxBatch:
+                    raise _HTTPError(413, f"At most {self.maxBatch} questions per batch")
+                # identical questions are only answered once
+                unique = list(dict.fromkeys(questions))
+                assert self._queue is not None
+                if self.queueSize - self._queue.qsize() < len(unique):
+                    self.rejected += 1
+                    raise _HTTPError(503, "Too many queued questions", {"Retry-After": "1"})
+                futures = [self._submit(lambda question=question: self._answer(persona, question)) for question in unique]
+                answers = await asyncio.gather(*futures, return_exceptions=True)
+                byQuestion = {}
+                for question, answer in zip(unique, answers):
+                    if isinstance(answer, Exception):
+                        byQuestion[question] = {"question": question, "error": f"{type(answer).__name__}: {answer}"}
+                    else:
+                        byQuestion[question] = {"question": question, "id": answer["id"], "answer": answer["answer"]}
+                await self._respond(writer, endpoint, 200, {"persona": persona, "results": [byQuestion[question] for question in questions]}, keepAlive)
+            elif endpoint == "/stream":
+                question = self._question(request)
+                await self._stream(writer, persona, question)
+                return False
+            else:
+                raise _HTTPError(404, f"No endpoint {path}")
+            return keepAlive
+        except _HTTPError as exception:
+            await self._respond(writer, endpoint, exception.status, {"error": str(exception)}, keepAlive, exception.headers)
+            return keepAlive
+        except Exception as exception:
+            await self._respond(writer, endpoint, 500, {"error": f"{type(exception).__name__}: {exception}"}, keepAlive)
+            return keepAlive
+
+    async def _stream(self, writer: asyncio.StreamWriter, persona: str, question: str):
+        events: "asyncio.Queue[Tuple[str, object]]" = asyncio.Queue()
+        stopped = asyncio.Event()
+        future = self._submit(lambda: self._streamAnswer(persona, question, events, stopped))
+        self._count("/stream", 200)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        try:
+            while True:
+                kind, data = await events.get()
+                if kind == "end":
+                    break
+                writer.write(f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # stops the generation when the client went away
+            stopped.set()
+            if not future.done():
+                future.cancel()
+
+    def _count(self, endpoint: str, status: int):
+        key = (endpoint, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+
+    async def _respond(self, writer: asyncio.StreamWriter, endpoint: str, status: int, body: Dict, keepAlive: bool, headers: Union[Dict[str, str], None] = None):
+        await self._respondRaw(writer, endpoint, status, json.dumps(body).encode("utf-8"), "application/json", keepAlive, headers)
+
+    async def _respondRaw(self, writer: asyncio.StreamWriter, endpoint: str, status: int, payload: bytes, contentType: str, keepAlive: bool, headers: Union[Dict[str, str], None] = None):
+        self._count(endpoint, status)
+        lines = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            f"Content-Type: {contentType}",
+            f"Content-Length: {len(payload)}",
+            f"Connection: {'keep-alive' if keepAlive and not self.draining else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    # the library's stage histograms plus the server's own gauges and counters
+    def metrics(self) -> str:
+        prefix = self.exporter.prefix
+        registryStats = self.registry.stats()
+        lines = [
+            f"# TYPE {prefix}_queue_depth gauge",
+            f"{prefix}_queue_depth {self._queue.qsize() if self._queue is not None else 0}",
+            f"# TYPE {prefix}_active_questions gauge",
+            f"{prefix}_active_questions {self.active}",
+            f"# TYPE {prefix}_rejected_total counter",
+            f"{prefix}_rejected_total {self.rejected}",
+            f"# TYPE {prefix}_responses_total counter",
+        ]
+        for (endpoint, status), count in sorted(self.responses.items()):
+            lines.append(f'{prefix}_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+        lines.append(f"# TYPE {prefix}_personas_resident gauge")
+        lines.append(f"{prefix}_personas_resident {registryStats['resident']}")
+        lines.append(f"# TYPE {prefix}_persona_loads_total counter")
+        lines.append(f"{prefix}_persona_loads_total {registryStats['loads']}")
+        lines.append(f"# TYPE {prefix}_persona_evictions_total counter")
+        lines.append(f"{prefix}_persona_evictions_total {registryStats['evictions']}")
+        return self.exporter.render() + "\n".join(lines) + "\n"
+
+def _interface(args) -> LLMInterface:
+    if args.openai:
+        import os
+        from .LLMInterfaces import OpenAI
+        return OpenAI(os.environ["OPENAI_API_KEY"])
+    from .LLMInterfaces import AsyncLlamaCPPServer
+    return ReplicaSet([AsyncLlamaCPPServer(url) for url in args.url])
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m directRetrieval.serve", description="Serve the personas of a config directory over HTTP")
+    parser.add_argument("configDirectory", help="directory of persona configs, <name>.config or <name>.json")
+    parser.add_argument("--url", action="append", default=[], help="llama.cpp server chat completions URL, repeat for several replicas")
+    parser.add_argument("--openai", action="store_true", help="use the OpenAI API with OPENAI_API_KEY instead of llama.cpp servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=32, help="questions answered concurrently")
+    parser.add_argument("--queue-size", type=int, default=1024, help="questions waiting for a worker before new ones are rejected with 503")
+    parser.add_argument("--max-batch", type=int, default=256, help="questions per /batch request, at most --queue-size")
+    parser.add_argument("--capacity", type=int, default=32, help="personas kept loaded")
+    parser.add_argument("--artifacts", action="store_true", help="load personas through compiled artifacts")
+    parser.add_argument("--prompt-cache-slots", type=int, default=0, help="llama.cpp server slots to pin to resident personas; a pinned persona's requests all go to its one slot and are answered one at a time")
+    parser.add_argument("--reload-interval", type=float, help="seconds between checks of the persona files for changes")
+    parser.add_argument("--shutdown-timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    if not args.openai and not args.url:
+        args.url = ["http://localhost:8080/v1/chat/completions"]
+    registry = QnAModelRegistry(_interface(args), args.configDirectory, capacity=args.capacity, useArtifacts=args.artifacts, promptCacheSlots=args.prompt_cache_slots, reloadInterval=args.reload_interval)
+    server = QnAServer(registry, workers=args.workers, queueSize=args.queue_size, maxBatch=args.max_batch, shutdownTimeout=args.shutdown_timeout)
+    asyncio.run(server.serve(args.host, args.port))
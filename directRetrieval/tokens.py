@@ -0,0 +1,82 @@
+from typing import List, Dict, Union
+import sys
+from urllib.parse import urlsplit
+from .LLMInterfaces import LLMInterface
+
+# tokens added by the chat template around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+class TokenEstimator:
+    exact: bool = False
+    cacheSize: int = 256
+
+    def __init__(self):
+        self._cache: Dict[str, int] = {}
+
+    def _count(self, text: str) -> int:
+        # roughly 4 characters per token for english text and JSON
+        return (len(text) + 3) // 4
+
+    def countTokens(self, text: str, cache: bool = True) -> int:
+        if not cache:
+            return self._count(text)
+        # the same system message is counted on every call, remember the last few texts
+        count = self._cache.get(text)
+        if count is None:
+            count = self._count(text)
+            if len(self._cache) >= self.cacheSize:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[text] = count
+        return count
+
+    def countMessages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.countTokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+class LlamaCPPTokenEstimator(TokenEstimator):
+    exact = True
+
+    def __init__(self, llama):
+        super().__init__()
+        self.llama = llama
+
+    def _count(self, text: str) -> int:
+        return len(self.llama.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+class ServerTokenEstimator(TokenEstimator):
+    exact = True
+    url: str
+
+    def __init__(self, url: str):
+        super().__init__()
+        # accept the chat completions URL of the server, /tokenize lives at the root
+        parts = urlsplit(url)
+        self.url = f"{parts.scheme}://{parts.netloc}/tokenize"
+        self._fallback = TokenEstimator()
+        self._session = None
+
+    def _count(self, text: str) -> int:
+        if not self.exact:
+            return self._fallback._count(text)
+        import requests
+        if self._session is None:
+            self._session = requests.Session()
+        try:
+            response = self._session.post(self.url, json={"content": text}, timeout=30)
+            response.raise_for_status()
+            return len(response.json()["tokens"])
+        except (requests.RequestException, KeyError, ValueError):
+            # the server does not expose /tokenize (or is down), use the approximation from now on rather
+            # than waiting for it again on every count
+            self.exact = False
+            return self._fallback._count(text)
+
+def tokenEstimatorFor(llm: Union[LLMInterface, None]) -> TokenEstimator:
+    # an llm can only be a llama.cpp server when its module was imported, checking does not import it
+    servers = sys.modules.get(f"{__package__}.LLMInterfaces.LLamaCPPServer")
+    if servers is not None and isinstance(llm, (servers.LlamaCPPServer, servers.AsyncLlamaCPPServer)):
+        return ServerTokenEstimator(llm.url)
+    # LLamaCPP is only importable with llama_cpp installed, recognise it by its wrapped model
+    llama = getattr(llm, "llama", None)
+    if llama is not None and hasattr(llama, "tokenize"):
+        return LlamaCPPTokenEstimator(llama)
+    return TokenEstimator()